@@ -23,14 +23,53 @@ __copyright__  = '(c) 2017 by Robert P'
 
 __usage__ = \
 """
-Usage: kbd-tst.py [id] [layout] [-h|--help]
+Usage: kbd-tst.py [id|device] [layout] [options] [-h|--help]
        kbd-tst.py [-h|--help] [layout] [id]
-       
-    -h     ... shows this usage help and quits
-    --help ... shows this usage help and quits
-    id     ... optional keyboard xinput id as shown in 'xinput list' output (default user assisted autodetection)
-    layout ... optional keyboard ASCII layout file [*.lay] (default the first file in kbd-tst dir)
-    
+
+    -h               ... shows this usage help and quits
+    --help           ... shows this usage help and quits
+    id               ... optional keyboard xinput id as shown in 'xinput list' output (default user assisted autodetection)
+    device           ... optional event device path like /dev/input/event5 or a pipe with recorded input_event records (implies evdev)
+    layout           ... optional keyboard ASCII layout file [*.lay] (default the first file in kbd-tst dir)
+
+Options:
+    -e|--evdev       ... read kernel input events directly from /dev/input/eventN instead of 'xinput test' (id is N)
+    -s|--station     ... station mode: test all newly connected keyboards at once, each in its own screen tile
+    -f|--frames      ... report frame pacing statistics (painted/dropped frames, adaptive frame interval) and startup
+                         time (process start to the first frame drawn) at the end of test
+    -a|--autolayout  ... switch to the layout file matching most of pressed keys (from kbd-tst dir, its layouts subdir and
+                         actual dir) automatically, without this option the better layout is only suggested in footer
+    -r|--rollover    ... N-key rollover and ghosting test: press and hold all keys of prompted (yellow) chord patterns,
+                         reports max registered chord and ghost keys (magenta) which appear without being pressed
+    --record=log     ... record all key events with monotonic timestamps into binary session log file
+    --replay=log     ... replay binary session log instead of reading keyboard (in real time)
+    --fast           ... replay session log as fast as possible
+    --chatter=ms[,n] ... flag key as chattering if at least n (default 2) gaps between its events are shorter than ms
+                         (default 5 ms), flagged keys are counted in footer and listed with timing stats in report
+                         (xinput events have only read timestamps, use --evdev for reliable gaps)
+    --rate=hz        ... polling rate test (evdev): mash keys to estimate report interval and jitter from kernel timestamps,
+                         reports pass/fail against target rate hz (125/250/500/1000)
+    --headless[=fd]  ... no terminal drawing and no prompts: stream JSON lines (events, key state changes, messages and
+                         final summary) to stdout or file descriptor fd, exit code 1 if test failed (requires id or device)
+    --idle=s         ... end test after s seconds without key events (also while disconnected keyboard is not reconnected)
+    --latency        ... measure end-to-end latency from event timestamp (kernel or xinput read time) to flushed screen
+                         update, live p50/p99 in footer and percentiles in report
+    --profile[=file] ... time event pipeline stages (read, parse, process, lookup, draw, render, stats), print breakdown
+                         at the end and optionally write collapsed stacks file for flame graph tools
+    --daemon[=sock]  ... run as daemon keeping keymap, layouts and device list warm in memory, front-end terminals attach
+                         over Unix socket sock (default $XDG_RUNTIME_DIR/kbd-tst-UID.sock), layout is the default one
+    --attach[=sock]  ... run the test of keyboard id with layout in daemon drawn on this terminal (or streamed as JSON
+                         lines with --headless), CTRL-C detaches, without id shows daemon status
+    --dashboard[=at] ... live dashboard of all sessions (key states, footer stats, messages) for web browsers at localhost
+                         port (default http://127.0.0.1:8088/) or Unix socket path, server-sent events stream at /events
+    --history[=n]    ... keep the last n (default 8192) key events in memory and dump them into session log file (replayable
+                         by --replay) on SIGUSR1, on typed phrase 'dump' and automatically when test failed
+    --db=path        ... store test session (device, layout, result, per key tested/presses/timing) into SQLite database
+    --query[=model]  ... with --db lists keys failing most (untested or chattering) on device model (as shown in footer)
+                         or on all devices
+    --bench          ... benchmark event -> render pipeline with synthetic bursts on shipped layouts (or given layout),
+                         prints JSON line with events/s and p50/p99/p999 per event latency for each layout and profile
+
 Notes: 
     * parameters are optional
     * not providing xinput id will initiate a user assisted autodetection sequence requiring physical disconneting 
@@ -44,10 +83,11 @@ Notes:
     * to end test prematurely just type phrase 'quit' (without the quotes)
     
 Known issues:
-    - keys ike apple keyb VOL+/VOL-/MUTE/EJECT do not generate xinput events and therefore cannot be tested right now 
-    - if more than one xinput id is found by autodetection sequence only the first one is used, which is some cases
-      might be incorrect. In this case provide the correct xinput id as a parameter (id can be found by trial and error
-      from 'xinput list' and verified by 'xinput test id' to check 'key press xx' and 'key release xx' events) 
+    - keys ike apple keyb VOL+/VOL-/MUTE/EJECT do not generate xinput events and therefore cannot be tested by xinput,
+      they are shown as missing keycodes (test ends with warning), with --evdev they are tested as any other key 
+    - if more than one xinput id is found by autodetection sequence the user is asked to press any key and the id which
+      emits the key event is used. If this is not the correct one provide the correct xinput id as a parameter (id can be
+      found by trial and error from 'xinput list' and verified by 'xinput test id' to check 'key press xx' and 'key release xx' events) 
       [ xinput double entries related bug: https://bugs.launchpad.net/ubuntu/+source/hal/+bug/277946 ]
     
 """
@@ -57,6 +97,83 @@ import re
 import subprocess, os
 import datetime, time
 import termios
+import struct, stat
+import select
+import signal, errno
+import array
+import hashlib, marshal
+import socket
+import ctypes, ctypes.util
+import fcntl
+import json
+import threading
+import sqlite3
+
+
+# libc for inotify and clock_gettime (find_library runs ldconfig subprocess, so only if there is no libc.so.6)
+try:
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+except OSError:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+CLOCK_MONOTONIC, CLOCK_BOOTTIME = 1, 7
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+
+def monotonic():
+    """ CLOCK_MONOTONIC time [s] used for all event timestamps (python 2 has no time.monotonic), own timespec per call
+        as it runs in dashboard thread too """
+    ts = timespec()
+    libc.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+def process_start():
+    """ monotonic time of process start (interpreter startup included) from /proc, None if not available """
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+    except (IOError, ValueError, IndexError):
+        return None
+    # start time is in clock ticks since boot
+    ts = timespec()
+    libc.clock_gettime(CLOCK_BOOTTIME, ctypes.byref(ts))
+    return monotonic() - (ts.tv_sec + ts.tv_nsec * 1e-9 - float(ticks) / os.sysconf('SC_CLK_TCK'))
+
+
+# process start for startup time (module load time if there is no /proc)
+STARTED = process_start() or monotonic()
+
+
+def percentile(values, q):
+    """ q-quantile (0..1) of sorted values, None for no values """
+    return values[int(q * (len(values) - 1))] if len(values) else None
+
+
+class Ring:
+    """ fixed size ring buffer backed by array - keeps the last capacity values without allocation per value """
+
+    def __init__(self, capacity, typecode='d'):
+        self.data = array.array(typecode, [0]) * capacity
+        self.capacity = capacity
+        # next write position and count of valid values
+        self.pos, self.count = 0, 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        self.data[self.pos] = value
+        self.pos = (self.pos + 1) % self.capacity
+        if self.count < self.capacity: self.count += 1
+
+    def values(self):
+        """ valid values oldest first """
+        if self.count < self.capacity: return self.data[:self.count]
+        return self.data[self.pos:] + self.data[:self.pos]
 
 
 class Gui:
@@ -106,10 +223,28 @@ class Gui:
 
     header = '= %(about)s = version %(version)s = Press Key by Key until done = %(github)s = xinput %(xinputver)s = %(c)s ='
 
-    footer = '= x.id: %(id)d [ %(devname)s ] = File: %(layout)s = Keys: %(total)3d = Tested: %(tested)3d = To go: %(togo)3d = Missing keycodes: %(missing)3d ='
+    # key state -> (fg, bg) color
+    KEYCOLOR = {
+        'press':    ('black', 'red'),
+        'release':  ('black', 'green'),
+        'untested': ('reset', 'reset'),
+        'prompt':   ('black', 'yellow'),
+        'ghost':    ('white', 'magenta')
+    }
+
+    # frame pacing: interval limits [s], interval as multiple of measured write/flush latency
+    FRAME_MIN, FRAME_MAX, FRAME_FACTOR = 1.0/60, 0.5, 4
+
+    # minimal time [s] the pressed key is shown even if released sooner
+    VISIBLE = 0.1
 
-    def __init__(self, xinputver):
-        """ update header template with configurable strings and xinput version """
+    footer = '= x.id: %(id)s [ %(devname)s ] = File: %(layout)s = Keys: %(total)3d = Tested: %(tested)3d = To go: %(togo)3d = Pressed: %(pressed)2d = Missing keycodes: %(missing)3d = Chatter: %(chatter)d =%(extra)s'
+
+    def __init__(self, xinputver, top=1, out=None):
+        """ update header template with configurable strings and xinput version, top is the 1st screen row (tile) """
+        self.top = top
+        # output stream (terminal)
+        self.out = out or sys.stdout
         data = {
             'about'     : __about__,
             'version'   : __version__,
@@ -118,13 +253,32 @@ class Gui:
             'c'         : __copyright__
         }
         self.header = self.header % data
+        # cell grid: key position (row,col) -> {state: precomputed ANSI string}
+        self.cells = {}
+        # key state actually shown on screen and states changed since last render
+        self.screen, self.dirty = {}, {}
+        # footer shown on screen and the pending one
+        self.footerline, self.footernext = None, None
+        # releases waiting until the press has been visible long enough, time the press has been shown
+        self.pending, self.shown = {}, {}
+        # frame pacing - adaptive interval, smoothed write/flush latency, next frame time
+        self.interval, self.latency, self.nextframe = self.FRAME_MIN, 0.0, 0.0
+        # frame stats: painted frames, deferred (dropped) frames, key states never painted
+        self.frames, self.dropped, self.coalesced = 0, 0, 0
+        # viewport: terminal size (None = unlimited), shown map lines
+        self.rows, self.cols = None, None
+        # (rows, cols) of remote terminal (daemon session), None = ask output terminal
+        self.size = None
+        self.maplines = 0
+        # all keys by position, positions of keys outside of viewport and their states, summary strip needs repaint
+        self.keys, self.hidden, self.offscreen, self.stripdirty = {}, [], {}, False
 
     def flush(self):
-        sys.stdout.flush()
+        self.out.flush()
 
     def write(self, str):
-        """ write directly to stdout """
-        sys.stdout.write(str)
+        """ write directly to output (stdout) """
+        self.out.write(str)
 
     def write_flush(self, str):
         """ write directly to stdout and flush """
@@ -147,8 +301,20 @@ class Gui:
 
     def write_at(self, line1, col1):
         """ set cursor position at line,col (1-based) """
-        str = '%d;%dH' % (line1, col1)
-        self.write_esc(str)
+        self.write(self.at(line1, col1))
+
+    def esc(self, str):
+        """ ANSI escape sequence as string """
+        return '%s[%s' % (self.ESC, str)
+
+    def at(self, line1, col1):
+        """ cursor position sequence at line,col (1-based) as string """
+        return self.esc('%d;%dH' % (line1, col1))
+
+    def sgr(self, attr=None, fg=None, bg=None):
+        """ ANSI color sequence as string """
+        seq = [ "%d" % dct.get(var) for var,dct in zip([attr, fg, bg], [self.ATTR, self.FG, self.BG]) if var is not None ]
+        return self.esc(';'.join(seq) + 'm')
 
     def home(self):
         """ set cursor home position = (1,1) """
@@ -184,12 +350,7 @@ class Gui:
 
     def color(self, attr=None, fg=None, bg=None):
         """ send ANSI color """
-        seq = []
-        for var,dct in zip([attr, fg, bg], [self.ATTR, self.FG, self.BG]):
-            if var is None: continue
-            a = "%d" %  dct.get(var)
-            if a: seq.append(a)
-        self.write_attr(seq)
+        self.write(self.sgr(attr, fg, bg))
 
     def color_reset(self):
         """ reset attr, fg, bg """
@@ -206,29 +367,62 @@ class Gui:
 
     def print_(self, str):
         """ print and stay on line """
-        print str,
+        print >>self.out, str,
 
     def print_ln(self, str=''):
-        """ print with newline """
-        print str
+        """ print with newline at current row (clipped to terminal width) """
+        self.write_at(self.atrow, 1)
+        self.clear_line()
+        print >>self.out, self.clip(str)
         self.atrow += 1
 
+    def term_size(self):
+        """ terminal (rows, cols) by TIOCGWINSZ, (None, None) if output is not a terminal """
+        if self.size: return self.size
+        try:
+            rows, cols = struct.unpack('hhhh', fcntl.ioctl(self.out.fileno(), termios.TIOCGWINSZ, '\0' * 8))[:2]
+        except (IOError, AttributeError, ValueError):
+            return None, None
+        return rows or None, cols or None
+
+    def clip(self, str):
+        """ text clipped to terminal width """
+        return str if self.cols is None else str[:self.cols]
+
+    def visible(self, keydict):
+        """ key is inside of viewport """
+        return keydict['row'] < self.maplines and (self.cols is None or keydict['col'] + len(keydict['label']) <= self.cols)
+
     def set_map(self, map):
-        """ set gui map layout """
+        """ set gui map layout (drops precomputed cells of previous one) """
         self.map = map
+        self.cells, self.keys = {}, {}
 
     def show_map(self):
-        """ clears screen and draws layout map """
-        self.clear_screen()
+        """ clears screen (or just own tile) and draws layout map clipped to terminal size """
+        self.rows, self.cols = self.term_size()
+        if self.top == 1:
+            self.clear_screen()
+        else:
+            self.atrow = self.top
         self.show_header()
         self.maprow = self.atrow-1
+        # map lines fitting above summary strip and footer (tiles have fixed height)
+        self.maplines = len(self.map)
+        if self.rows and self.top == 1: self.maplines = max(0, min(self.maplines, self.rows - self.atrow - 1))
         #
-        for line in self.map:
+        for line in self.map[:self.maplines]:
             self.print_ln(line)
-        #
+        # summary strip of keys outside of viewport (empty if all keys are visible)
+        self.striprow = self.atrow
         self.print_ln()
         # footer = status line
         self.statusrow = self.atrow
+        # all keys are drawn as untested now
+        self.screen, self.dirty, self.pending, self.offscreen = {}, {}, {}, {}
+        self.hidden = sorted([ pos for pos,keydict in self.keys.items() if not self.visible(keydict) ])
+        self.stripdirty = bool(self.hidden)
+        self.footerline = None
 
     def show_header(self):
         """ show header line and separator line """
@@ -236,50 +430,267 @@ class Gui:
         self.print_ln()
 
     def update_stats(self, data):
-        """ print/update status line = footer """
-        self.write_at(self.statusrow, 1)
-        self.print_(self.footer % data)
+        """ update status line = footer (shown by the next render) """
+        self.footernext = self.footer % data
+
+    def set_keys(self, keydicts):
+        """ precompute ANSI strings for all keys and states, find keys outside of viewport """
+        for keydict in keydicts:
+            self.keys[keydict['row'], keydict['col']] = keydict
+            self.cell(keydict)
+        self.hidden = sorted([ pos for pos,keydict in self.keys.items() if not self.visible(keydict) ])
+        self.stripdirty = bool(self.hidden)
+
+    def cell(self, keydict):
+        """ precomputed ANSI strings {state: str} for key, computed on first use """
+        pos = keydict['row'], keydict['col']
+        cell = self.cells.get(pos)
+        if cell is None:
+            goto = self.at(keydict['row']+1+self.maprow, keydict['col']+1)
+            reset = self.sgr(attr='reset')
+            cell = dict([ (state, goto + self.sgr(fg=fg, bg=bg) + keydict['label'] + reset)
+                          for state,(fg,bg) in self.KEYCOLOR.items() ])
+            self.cells[pos] = cell
+        return cell
 
     def key_action(self, keydict, action):
-        """ visualize key action press (red) / release (green) """
-        if action == 'press':
-            self.color(fg='black', bg='red')
-        if action == 'release':
-            self.color(fg='black', bg='green')
-        row1,col1,txt = keydict['row']+1, keydict['col']+1, keydict['label']
-        self.write_at(row1+self.maprow, col1)
-        self.write_flush(txt)
-        # reset color back to normal
-        self.color(attr='reset')
+        """ visualize key action press (red) / release (green) - only marks the cell dirty, drawn by render """
+        pos = keydict['row'], keydict['col']
+        # outside of viewport - shown in summary strip
+        if not self.visible(keydict):
+            self.keys[pos] = keydict
+            if pos not in self.hidden: self.hidden = sorted(self.hidden + [pos])
+            self.offscreen[pos] = action
+            self.stripdirty = True
+            return
+        self.cell(keydict)
+        # newer state than pending release
+        if action != 'release': self.pending.pop(pos, None)
+        if pos in self.dirty:
+            # only the latest state per key is painted
+            self.coalesced += 1
+            # press not painted yet - paint it and release later
+            if self.dirty[pos] == 'press' and action == 'release':
+                self.pending[pos] = action
+                return
+        self.dirty[pos] = action
+
+    def frame_wait(self):
+        """ time [s] to wait for the next frame if there is something to paint, None otherwise """
+        if not (self.dirty or self.pending or self.stripdirty or self.footernext != self.footerline): return None
+        return max(0.0, self.nextframe - time.time())
+
+    def render(self, force=False):
+        """ write all changed cells and footer as single write and flush, at most once per frame interval,
+            returns False if the frame has been deferred """
+        now = time.time()
+        if not force and now < self.nextframe:
+            self.dropped += 1
+            return False
+        # releases of presses shown long enough
+        for pos,state in self.pending.items():
+            if pos in self.dirty and not force: continue
+            if force or now - self.shown.get(pos, 0) >= self.VISIBLE:
+                self.dirty[pos] = self.pending.pop(pos)
+        out = []
+        for pos,state in self.dirty.iteritems():
+            if self.screen.get(pos) == state: continue
+            # short press stays visible for a while
+            if state == 'release' and not force and now - self.shown.get(pos, 0) < self.VISIBLE:
+                self.pending[pos] = state
+                continue
+            out.append(self.cells[pos][state])
+            self.screen[pos] = state
+            if state == 'press': self.shown[pos] = now
+        self.dirty = {}
+        if self.stripdirty:
+            out.append(self.strip())
+            self.stripdirty = False
+        if self.footernext != self.footerline:
+            out.append(self.at(self.statusrow, 1) + self.clip(self.footernext) + self.esc('0K'))
+            self.footerline = self.footernext
+        if out:
+            self.write_flush(''.join(out))
+            # adapt frame interval to smoothed write/flush latency
+            self.latency += (time.time() - now - self.latency) * 0.1
+            self.interval = min(self.FRAME_MAX, max(self.FRAME_MIN, self.FRAME_FACTOR * self.latency))
+            self.frames += 1
+        self.nextframe = now + self.interval
+        return True
+
+    def strip(self):
+        """ summary strip of keys outside of viewport - key names colored by state in map order, clipped to width """
+        names = [ (self.keys[pos]['key'], self.offscreen.get(pos, 'untested')) for pos in self.hidden ]
+        width = (self.cols or 1000) - 8
+        out, used = [ self.at(self.striprow, 1), 'Hidden:' ], 7
+        for i,(name,state) in enumerate(names):
+            if used + len(name) + 1 > width:
+                out.append(' +%d' % (len(names) - i))
+                break
+            fg, bg = self.KEYCOLOR[state]
+            out.append(' ' + self.sgr(fg=fg, bg=bg) + name + self.sgr(attr='reset'))
+            used += len(name) + 1
+        return ''.join(out) + self.esc('0K')
+
+    def redraw(self):
+        """ repaint whole screen (terminal resize) - map clipped to new size, actual key states and footer,
+            precomputed cells are kept (key position on screen does not depend on terminal size) """
+        states = dict(self.offscreen)
+        for shown in (self.screen, self.dirty, self.pending): states.update(shown)
+        self.show_map()
+        for pos,state in states.items():
+            if state == 'untested': continue
+            if pos in self.hidden: self.offscreen[pos] = state
+            else: self.dirty[pos] = state
+        self.render(force=True)
+
+    def frame_stats(self):
+        """ frame pacing statistics as text """
+        return "frames painted: %d = dropped: %d = key states coalesced: %d = frame interval: %.1f ms = write latency: %.2f ms" \
+               % (self.frames, self.dropped, self.coalesced, 1000 * self.interval, 1000 * self.latency)
+
+    def status(self, txt, bg='cyan'):
+        """ replace status line = footer with colored text """
+        self.write_at(self.statusrow, 1)
+        self.clear_line()
+        self.color(fg='black', bg=bg)
+        self.write(self.clip(txt))
+        self.color_reset()
+        # the next render with footer stats replaces it
+        self.footerline = txt
 
     def banner(self, txt, bg='cyan', above=1, bellow=1):
         for i in range(above):
-            print
+            print >>self.out
         #
         self.color(fg='black', bg=bg)
-        print txt
+        print >>self.out, txt
         self.color_reset()
         self.flush()
         #
         for i in range(bellow):
-            print
+            print >>self.out
+
+    def park(self):
+        """ cursor bellow the footer """
+        self.write_at(self.statusrow + 1, 1)
 
     def dbg(self, txt):
-        self.write_at(25,1)
-        print txt
+        self.park()
+        print >>self.out, txt
+
+
+class Headless:
+    """ Gui replacement for scripted runs - JSON lines per event and key state change, no terminal drawing """
+
+    def __init__(self, xinputver, fd=1):
+        """ JSON lines go to file descriptor fd (default stdout) """
+        self.fd = fd
+        # output file instead of fd (daemon client)
+        self.out = None
+        self.xinputver = xinputver
+        # JSON lines waiting for the next render (flush per batch)
+        self.lines = []
+        # key position (row,col) -> last reported state
+        self.screen = {}
+
+    def emit(self, record):
+        """ queue single JSON line """
+        self.lines.append(json.dumps(record, sort_keys=True))
+
+    def render(self, force=False):
+        """ write all queued lines by single write """
+        if not self.lines: return True
+        data = '\n'.join(self.lines) + '\n'
+        self.lines = []
+        if self.out:
+            self.out.write(data)
+            self.out.flush()
+            return True
+        while data:
+            data = data[os.write(self.fd, data):]
+        return True
+
+    def frame_wait(self):
+        """ no frame pacing - the whole batch is written at once """
+        return None
+
+    def redraw(self):
+        pass
+
+    def set_map(self, map):
+        self.map = map
+
+    def show_map(self):
+        self.screen = {}
+
+    def set_keys(self, keydicts):
+        pass
+
+    def event(self, action, keycode, tstamp, keydict=None):
+        """ single input event, keydict is None for keys not in layout """
+        self.emit({'type': 'event', 'action': action, 'keycode': keycode, 't': round(tstamp, 6),
+                   'key': keydict and keydict['key']})
+
+    def key_action(self, keydict, action):
+        """ key state change (press / release / prompt / ghost / untested) """
+        pos = keydict['row'], keydict['col']
+        if self.screen.get(pos) == action: return
+        self.screen[pos] = action
+        self.emit({'type': 'state', 'key': keydict['key'], 'keycode': keydict['keycode'], 'state': action})
+
+    def update_stats(self, data):
+        self.stats = data
+
+    def park(self):
+        pass
+
+    def status(self, txt, bg='cyan'):
+        self.banner(txt, bg)
+
+    def banner(self, txt, bg='cyan', above=1, bellow=1):
+        """ message with color as severity """
+        self.emit({'type': 'message', 'text': txt.strip(' ='), 'color': bg})
+        self.render()
+
+    def summary(self, record):
+        """ final summary record """
+        record['type'] = 'summary'
+        record['xinput'] = self.xinputver
+        self.emit(record)
+        self.render()
+
+    def frame_stats(self):
+        return "frames: headless"
+
 
 class Xinput:
     """ executing xinput as subprocess """
 
+    # 'key press   36 ' / 'key release 36 ' fixed offset fields: action at [4:11], keycode from [12:]
+    ACTION = {
+        'press  ': 'press',
+        'release': 'release'
+    }
+
+    # max bytes read at once
+    BULK = 65536
+
     def __init__(self):
         self.exe = 'xinput'
+        # incomplete last line from previous read
+        self.buf = ''
+        # count of lines which could not be parsed
+        self.bad = 0
 
-    def version(self):
-        """ get actual xinput version or error message if not found """
-        args = [self.exe, '--version']
+    def run(self, *args):
+        """ launch xinput with args, stdout is collected by the caller """
+        return subprocess.Popen((self.exe,) + args, stdout=subprocess.PIPE)
+
+    def version(self, proc=None):
+        """ get actual xinput version or error message if not found, proc is already launched 'xinput --version' """
         try:
-            xinput = subprocess.Popen(args, stdout=subprocess.PIPE)
-            (stdout,stderr) = xinput.communicate()
+            (stdout,stderr) = (proc or self.run('--version')).communicate()
         except OSError as e:
             return e.strerror
         # stdout
@@ -290,11 +701,9 @@ class Xinput:
         #
         return '?'
 
-    def list(self, filter='keyboard', trim=True):
-        """ list xinput devices with optional filter """
-        args = [self.exe, 'list']
-        xinput = subprocess.Popen(args, stdout=subprocess.PIPE)
-        (stdout,stderr) = xinput.communicate()
+    def list(self, filter='keyboard', trim=True, proc=None):
+        """ list xinput devices with optional filter, proc is already launched 'xinput list' """
+        (stdout,stderr) = (proc or self.run('list')).communicate()
         return [ line.strip() if trim else line for line in stdout.splitlines() if filter in line ]
 
     def name_by_id(self, id):
@@ -312,7 +721,7 @@ class Xinput:
             return "%s - %s" % (self.exe, e.strerror)
 
     def is_running(self):
-        return self.xinput and (self.xinput.poll() is None)
+        return bool(self.xinput) and (self.xinput.poll() is None)
 
     def stop(self):
         """ terminate xinput subprocess """
@@ -320,211 +729,993 @@ class Xinput:
             #self.xinput.stdout.readline()
             self.xinput.terminate()
 
-    def readline(self):
-        """ read stdout line of xinput """
-        return self.xinput.stdout.readline()
+    def fileno(self):
+        """ xinput stdout for select """
+        return self.xinput.stdout.fileno()
 
+    def events(self, timeout=None):
+        """ read all available xinput output at once and decode it as list of (action, keycode, timestamp) """
+        # nothing within timeout
+        if timeout is not None and not select.select([self.fileno()], [], [], timeout)[0]: return []
+        data = os.read(self.fileno(), self.BULK)
+        # EOF = xinput ended
+        if not data:
+            self.xinput.wait()
+            return []
+        return self.parse(data, monotonic())
 
-class Layout:
-    """ keyboard layout """
+    def parse(self, data, tstamp):
+        """ split data into lines and decode key events by fixed offsets (no regex), count unparsable lines """
+        lines = (self.buf + data).split('\n')
+        # the last line is incomplete (or empty)
+        self.buf = lines.pop()
+        events, action = [], self.ACTION
+        for line in lines:
+            try:
+                if line[:4] != 'key ': raise ValueError(line)
+                events.append((action[line[4:11]], int(line[12:].split(None, 1)[0]), tstamp))
+            except (KeyError, ValueError, IndexError):
+                self.bad += 1
+        return events
 
-    # reverse xmodmap -pk (use rev_xmodmap.sh for possible updates)
-    # key -> keycode
-    rev_xmodmap = {
-        'ESC': 9,
-        '1': 10,
-        '2': 11,
-        '3': 12,
-        '4': 13,
-        '5': 14,
-        '6': 15,
-        '7': 16,
-        '8': 17,
-        '9': 18,
-        '0': 19,
-        '-': 20,
-        '=': 21,
-        'BS': 22,
-        'TAB': 23,
-        'q': 24,
-        'w': 25,
-        'e': 26,
-        'r': 27,
-        't': 28,
-        'y': 29,
-        'u': 30,
-        'i': 31,
-        'o': 32,
-        'p': 33,
-        '[': 34,
-        ']': 35,
-        'RET': 36,
-        'LCTR': 37,
-        'a': 38,
-        's': 39,
-        'd': 40,
-        'f': 41,
-        'g': 42,
-        'h': 43,
-        'j': 44,
-        'k': 45,
-        'l': 46,
-        ';': 47,
-        "'": 48,
-        '`': 49,
-        'LSHIFT': 50,
-        '\\': 51,
-        'z': 52,
-        'x': 53,
-        'c': 54,
-        'v': 55,
-        'b': 56,
-        'n': 57,
-        'm': 58,
-        ',': 59,
-        '.': 60,
-        '/': 61,
-        'RSHIFT': 62,
-        '_*': 63,
-        'LALT': 64,
-        'SPACEBAR': 65,
-        'CAPS': 66,
-        'F1': 67,
-        'F2': 68,
-        'F3': 69,
-        'F4': 70,
-        'F5': 71,
-        'F6': 72,
-        'F7': 73,
-        'F8': 74,
-        'F9': 75,
-        'F10': 76,
-        'NUML': 77,
-        'SCRL': 78,
-        '_7': 79,
-        '_8': 80,
-        '_9': 81,
-        '_-': 82,
-        '_4': 83,
-        '_5': 84,
-        '_6': 85,
-        '_+': 86,
-        '_1': 87,
-        '_2': 88,
-        '_3': 89,
-        '_0': 90,
-        '_.': 91,
-        'ISO_Level3_Shift': 92,
-        'less': 94,
-        'F11': 95,
-        'F12': 96,
-        'Katakana': 98,
-        'Hiragana': 99,
-        'Henkan_Mode': 100,
-        'XF86LaunchD': 101,
-        'Muhenkan': 102,
-        'ENT': 104,
-        'RCTR': 105,
-        '_/': 106,
-        'PSCR': 107,
-        'RALT': 108,
-        'Linefeed': 109,
-        'HOME': 110,
-        'UP': 111,
-        'PGUP': 112,
-        'LEFT': 113,
-        'RIGHT': 114,
-        'END': 115,
-        'DOWN': 116,
-        'PGDN': 117,
-        'INS': 118,
-        'DEL': 119,
-        'XF86AudioMute': 121,
-        'XF86AudioLowerVolume': 122,
-        'XF86AudioRaiseVolume': 123,
-        'XF86PowerOff': 124,
-        '_=': 125,
-        'plus-': 126,
-        'PAUS': 127,
-        'XF86LaunchA': 128,
-        'KP_Decimal': 129,
-        'Hangul': 130,
-        'Hangul_Hanja': 131,
-        'XF86LightBulb': 132,
-        'LAPPLE': 133,
-        'RAPPLE': 134,
-        'Menu': 135,
-        'Cancel': 136,
-        'Redo': 137,
-        'SunProps': 138,
-        'Undo': 139,
-        'SunFront': 140,
-        'XF86Copy': 141,
-        'XF86Open': 142,
-        'XF86Paste': 143,
-        'XF86AudioPrev': 144,
-        'XF86Cut': 145,
-        'Help': 146,
-        'XF86MenuKB': 147,
-        'XF86Calculator': 148,
-        'XF86Sleep': 150,
-        'XF86WakeUP': 151,
-        'XF86Explorer': 152,
-        'XF86AudioPGDN': 153,
-        'XF86Xfer': 155,
-        'XF86Launch1': 156,
-        'XF86Launch2': 157,
-        'XF86WWW': 158,
-        'XF86LaunchA': 159,
-        'XF86AudioMute': 160,
-        'XF86Calculator': 161,
-        'XF86AudioPAUS': 162,
-        'XF86Mail': 163,
-        'XF86AudioStop': 164,
-        'XF86Sleep': 165,
-        'XF86Back': 166,
-        'XF86Forward': 167,
-        'XF86Eject': 169,
-        'XF86Eject': 170,
-        'XF86AudioPGDN': 171,
-        'XF86AudioPlay': 172,
-        'XF86AudioPrev': 173,
-        'XF86AudioLowerVolume': 174,
-        'XF86AudioRecord': 175,
-        'XF86AudioRaiseVolume': 176,
-        'XF86Phone': 177,
-        'XF86WWW': 178,
-        'F13': 179,
-        'XF86HOMEPage': 180,
-        'XF86Reload': 181,
-        'XF86Close': 182,
-        'XF86ScrollUP': 185,
-        'XF86ScrollDOWN': 186,
-        'parenleft': 187,
-        'parenright': 188,
-        'XF86New': 189,
-        'Redo': 190,
-        'F13': 191,
-        'F14': 192,
-        'F15': 193,
-        'XF86Launch7': 194,
-        'XF86Launch8': 195,
-        'XF86Launch9': 196,
-        'XF86AudioMicMute': 198,
-        'XF86TouchpadToggle': 199,
-        'XF86TouchpadOn': 200,
-        'XF86TouchpadOff': 201,
-        'Mode_switch': 203,
-        'XF86Eject': 204,
+
+class Evdev:
+    """ reading kernel input events directly from /dev/input/eventN (no xinput subprocess) """
+
+    # struct input_event { struct timeval time; __u16 type; __u16 code; __s32 value; }
+    EVENT = struct.Struct('llHHi')
+
+    # event type key (EV_KEY)
+    EV_KEY = 0x01
+
+    # key event value -> action (autorepeat is reported as press like xinput does)
+    ACTION = {
+        0: 'release',
+        1: 'press',
+        2: 'press'
+    }
+
+    # X keycode = evdev code + 8
+    XOFFSET = 8
+
+    # bulk read size in events
+    BULK = 64
+
+    # ioctl EVIOCSCLOCKID = _IOW('E', 0xa0, int) - kernel timestamps from CLOCK_MONOTONIC
+    EVIOCSCLOCKID = 0x400445a0
+
+    def __init__(self):
+        self.exe = 'evdev'
+        self.fd = None
+        # incomplete event record from previous read
+        self.buf = ''
+        # count of key events with unknown value
+        self.bad = 0
+
+    @staticmethod
+    def is_device(path):
+        """ path looks like an event device or a pipe with recorded event records """
+        if not isinstance(path, str): return False
+        if path.startswith('/dev/'): return True
+        return os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode)
+
+    def devpath(self, id):
+        """ numeric id N -> /dev/input/eventN, path as is """
+        return '/dev/input/event%d' % id if isinstance(id, int) else id
+
+    def version(self):
+        """ no xinput involved """
+        return 'n/a (evdev)'
+
+    def list(self, filter='keyboard', trim=True):
+        """ list event devices from /proc/bus/input/devices in xinput list like format """
+        devs = []
+        try:
+            with open('/proc/bus/input/devices') as f:
+                blocks = f.read().split('\n\n')
+        except IOError:
+            return devs
+        for block in blocks:
+            name, handlers = '?', []
+            for line in block.splitlines():
+                if line.startswith('N: Name='):
+                    name = line[len('N: Name='):].strip('"')
+                if line.startswith('H: Handlers='):
+                    handlers = line[len('H: Handlers='):].split()
+            # only devices with kbd handler are keyboards
+            kind = 'keyboard' if 'kbd' in handlers else 'pointer'
+            for h in handlers:
+                if not h.startswith('event'): continue
+                line = '%s\tid=%s\t[evdev %s]' % (name, h[len('event'):], kind)
+                if filter in line: devs.append(line.strip() if trim else line)
+        return devs
+
+    def name_by_id(self, id):
+        """ device name from sysfs """
+        node = os.path.basename(self.devpath(id))
+        try:
+            with open('/sys/class/input/%s/device/name' % node) as f:
+                return f.read().strip()
+        except IOError:
+            return '?'
+
+    def start(self, id=8):
+        """ open event device id (number or path) """
+        path = self.devpath(id)
+        try:
+            self.fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            self.fd = None
+            return "%s - %s" % (path, e.strerror)
+        # monotonic kernel timestamps (not possible for pipe with recorded events)
+        try:
+            fcntl.ioctl(self.fd, self.EVIOCSCLOCKID, struct.pack('i', CLOCK_MONOTONIC))
+        except IOError:
+            pass
+
+    def is_running(self):
+        return self.fd is not None
+
+    def fileno(self):
+        """ event device for select """
+        return self.fd
+
+    def stop(self):
+        """ close event device """
+        if self.is_running():
+            os.close(self.fd)
+            self.fd = None
+
+    def events(self, timeout=None):
+        """ bulk read and decode all available key events as list of (action, keycode, timestamp) """
+        # nothing within timeout
+        if timeout is not None and not select.select([self.fd], [], [], timeout)[0]: return []
+        try:
+            data = os.read(self.fd, self.EVENT.size * self.BULK)
+        except OSError as e:
+            # device unplugged while reading
+            if e.errno != errno.ENODEV: raise
+            data = ''
+        # EOF = device unplugged or pipe closed
+        if not data:
+            self.stop()
+            return []
+        return self.parse(data)
+
+    def parse(self, data):
+        """ decode complete event records, keep incomplete tail for the next read """
+        buf = self.buf + data
+        size, unpack, events = self.EVENT.size, self.EVENT.unpack_from, []
+        end = len(buf) - len(buf) % size
+        for ofs in xrange(0, end, size):
+            sec, usec, type, code, value = unpack(buf, ofs)
+            if type != self.EV_KEY: continue
+            action = self.ACTION.get(value)
+            if action:
+                events.append((action, code + self.XOFFSET, sec + usec * 1e-6))
+            else:
+                self.bad += 1
+        self.buf = buf[end:]
+        return events
+
+
+
+class Record:
+    """ input backend wrapper recording all key events into binary session log """
+
+    # log header and record: monotonic timestamp [s], action (1 = press, 0 = release), keycode
+    MAGIC = 'KBDREC2\n'
+    RECORD = struct.Struct('<dBH')
+    # header -> record of all known versions (version 1 had byte keycodes, too small for evdev codes)
+    FORMATS = { 'KBDREC1\n': struct.Struct('<dBB'), MAGIC: RECORD }
+
+    def __init__(self, backend, fname):
+        self.backend = backend
+        self.log = open(fname, 'wb')
+        self.log.write(self.MAGIC)
+
+    def __getattr__(self, name):
+        """ everything else is served by wrapped backend """
+        return getattr(self.backend, name)
+
+    def events(self, timeout=None):
+        """ events from wrapped backend written to log as one block per batch """
+        events = self.backend.events(timeout)
+        if events:
+            pack = self.RECORD.pack
+            self.log.write(''.join([ pack(tstamp, action == 'press', keycode) for action,keycode,tstamp in events ]))
+        return events
+
+    def stop(self):
+        """ stop wrapped backend and close log """
+        self.backend.stop()
+        if not self.log.closed: self.log.close()
+
+
+class History:
+    """ the last capacity key events as session log records (see Record) in single fixed size array - no allocation
+        per event, memory does not grow, dump is session log which can be replayed """
+
+    # default capacity [events]
+    CAPACITY = 8192
+
+    def __init__(self, capacity=CAPACITY):
+        self.size, self.pack = Record.RECORD.size, Record.RECORD.pack_into
+        self.data = array.array('B', [0]) * (capacity * self.size)
+        self.capacity = capacity
+        # next write position and count of valid events
+        self.pos, self.count = 0, 0
+
+    def append(self, action, keycode, tstamp):
+        """ overwrite the oldest event """
+        self.pack(self.data, self.pos * self.size, tstamp, action == 'press', keycode)
+        self.pos = (self.pos + 1) % self.capacity
+        if self.count < self.capacity: self.count += 1
+
+    def records(self):
+        """ valid records oldest first """
+        end = self.pos * self.size
+        if self.count < self.capacity: return self.data[:end].tostring()
+        return self.data[end:].tostring() + self.data[:end].tostring()
+
+    def dump(self, fname):
+        """ write session log, returns error or None """
+        try:
+            with open(fname, 'wb') as f:
+                f.write(Record.MAGIC)
+                f.write(self.records())
+        except IOError as e:
+            return "%s - %s" % (fname, e.strerror)
+
+
+class Replay:
+    """ input backend replaying binary session log (see Record) in real time or as fast as possible """
+
+    # events per batch in fast mode
+    BULK = 64
+
+    def __init__(self, fname, fast=False):
+        self.exe = 'replay'
+        self.fname, self.fast = fname, fast
+        self.records = []
+        self.bad = 0
+
+    def version(self):
+        """ no xinput involved """
+        return 'n/a (replay)'
+
+    def list(self, filter='keyboard', trim=True):
+        return []
+
+    def name_by_id(self, id):
+        return 'replay %s' % self.fname
+
+    def start(self, id=None):
+        """ load session log, replay time starts now """
+        try:
+            with open(self.fname, 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            return "%s - %s" % (self.fname, e.strerror)
+        record = Record.FORMATS.get(data[:len(Record.MAGIC)])
+        if record is None:
+            return "%s - not a session log" % self.fname
+        size, unpack = record.size, record.unpack_from
+        end = len(data) - (len(data) - len(Record.MAGIC)) % size
+        self.records = [ unpack(data, ofs) for ofs in xrange(len(Record.MAGIC), end, size) ]
+        self.pos = 0
+        # recorded time -> replay time offset
+        self.shift = monotonic() - (self.records[0][0] if self.records else 0)
+
+    def is_running(self):
+        return self.pos < len(self.records)
+
+    def stop(self):
+        self.pos = len(self.records)
+
+    def fileno(self):
+        """ replay is always ready """
+        return None
+
+    def events(self, timeout=None):
+        """ next batch of recorded events - all already due in real time, BULK at once in fast mode """
+        if not self.is_running(): return []
+        if self.fast:
+            # recorded timing is kept (key timing and chatter stats), only nothing waits for it
+            batch = self.records[self.pos:self.pos + self.BULK]
+            self.pos += len(batch)
+            return [ ('press' if press else 'release', keycode, tstamp + self.shift) for tstamp,press,keycode in batch ]
+        # wait for the next due event, at most timeout
+        due = self.records[self.pos][0] + self.shift - monotonic()
+        if due > 0:
+            if timeout is not None and timeout < due:
+                time.sleep(timeout)
+                return []
+            time.sleep(due)
+        now, events = monotonic(), []
+        while self.pos < len(self.records) and self.records[self.pos][0] + self.shift <= now:
+            tstamp, press, keycode = self.records[self.pos]
+            events.append(('press' if press else 'release', keycode, tstamp + self.shift))
+            self.pos += 1
+        return events
+
+
+class Synthetic:
+    """ input backend generating synthetic key event bursts for benchmark """
+
+    # burst profiles
+    PROFILES = [ 'single', '6kro', 'nkro', 'repeat' ]
+
+    # keys per chord for nkro profile, autorepeat events per flood
+    NKRO, REPEAT = 16, 32
+
+    def __init__(self, keycodes, profile='single', count=10000):
+        """ generate at least count events by cycling over keycodes """
+        self.exe = 'synthetic'
+        self.bad = 0
+        self.profile = profile
+        self.bursts = self.generate(keycodes, profile, count)
+        self.pos = len(self.bursts)
+
+    def generate(self, keycodes, profile, count):
+        """ list of bursts = lists of (action, keycode) arriving at once """
+        bursts, n, i = [], 0, 0
+        while n < count and keycodes:
+            if profile == 'single':
+                kc = keycodes[i % len(keycodes)]
+                burst = [ [('press', kc)], [('release', kc)] ]
+                i += 1
+            elif profile in ['6kro', 'nkro']:
+                size = 6 if profile == '6kro' else self.NKRO
+                chord = [ keycodes[(i + j) % len(keycodes)] for j in range(size) ]
+                burst = [ [ ('press', kc) for kc in chord ], [ ('release', kc) for kc in chord ] ]
+                i += size
+            else:
+                kc = keycodes[i % len(keycodes)]
+                burst = [ [('press', kc)] * (1 + self.REPEAT), [('release', kc)] ]
+                i += 1
+            bursts += burst
+            n += sum(map(len, burst))
+        return bursts
+
+    def version(self):
+        return 'n/a (synthetic)'
+
+    def list(self, filter='keyboard', trim=True):
+        return []
+
+    def name_by_id(self, id):
+        return 'synthetic %s' % self.profile
+
+    def start(self, id=None):
+        self.pos = 0
+
+    def is_running(self):
+        return self.pos < len(self.bursts)
+
+    def stop(self):
+        self.pos = len(self.bursts)
+
+    def fileno(self):
+        return None
+
+    def events(self, timeout=None):
+        """ next burst timestamped now """
+        if not self.is_running(): return []
+        burst, now = self.bursts[self.pos], monotonic()
+        self.pos += 1
+        return [ (action, keycode, now) for action,keycode in burst ]
+
+
+class Registry:
+    """ device registry - backend version and device list are enumerated once and cached until hot-plug refresh,
+        xinput subprocesses for both are launched at once """
+
+    def __init__(self, backend):
+        self.backend = backend
+        # backend version, all device lines (None = not enumerated yet), launched enumerations
+        self.ver, self.devs, self.procs = None, None, {}
+
+    def prefetch(self):
+        """ launch version and list enumeration concurrently (subprocess backends only), collected on first use """
+        if not hasattr(self.backend, 'run'): return
+        for what,args in (('version', ['--version']), ('list', ['list'])):
+            try:
+                self.procs[what] = self.backend.run(*args)
+            except OSError:
+                pass
+
+    def version(self):
+        """ backend version (cached) """
+        if self.ver is None:
+            proc = self.procs.pop('version', None)
+            self.ver = self.backend.version(proc) if proc else self.backend.version()
+        return self.ver
+
+    def list(self, filter='keyboard', trim=True):
+        """ device list with optional filter (cached) """
+        if self.devs is None:
+            proc = self.procs.pop('list', None)
+            self.devs = self.backend.list('', False, proc) if proc else self.backend.list('', False)
+        return [ line.strip() if trim else line for line in self.devs if filter in line ]
+
+    def refresh(self):
+        """ devices changed (hot-plug) - enumerate again on next use """
+        self.devs = None
+
+    def names(self):
+        """ id -> device name of connected keyboards """
+        return dict([ (int(part[3:]), dev.split('\t')[0].strip('\xe2\x86\xb3 ')) for dev in self.list()
+                      for part in dev.split() if part.startswith('id=') ])
+
+    def name_by_id(self, id):
+        """ device name from cached list (or from backend if it does not enumerate by subprocess) """
+        if not hasattr(self.backend, 'run'): return self.backend.name_by_id(id)
+        return self.names().get(id, '?')
+
+
+class HotPlug:
+    """ input device hot-plug monitor - inotify on /dev/input, udev netlink or /proc/bus/input/devices polling """
+
+    # inotify_init1 / inotify_add_watch flags
+    IN_NONBLOCK, IN_CREATE, IN_DELETE = os.O_NONBLOCK, 0x100, 0x200
+
+    # struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+    INOTIFY_EVENT = struct.Struct('iIII')
+
+    # netlink kernel uevents
+    NETLINK_KOBJECT_UEVENT = 15
+
+    # polling fallback period [s]
+    POLL = 0.25
+
+    def __init__(self, path='/dev/input', proc='/proc/bus/input/devices'):
+        """ use the first available mechanism: inotify, netlink, polling """
+        self.path, self.proc = path, proc
+        self.fd, self.sock = None, None
+        self.kind = self.inotify() or self.netlink() or self.polling()
+
+    def inotify(self):
+        """ inotify watch on /dev/input via libc """
+        try:
+            fd = libc.inotify_init1(self.IN_NONBLOCK)
+            if fd < 0: return
+            if libc.inotify_add_watch(fd, self.path, self.IN_CREATE | self.IN_DELETE) < 0:
+                os.close(fd)
+                return
+        except (OSError, AttributeError):
+            return
+        self.fd = fd
+        return 'inotify'
+
+    def netlink(self):
+        """ kernel uevent netlink socket (the same source udev uses) """
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+        except (socket.error, AttributeError):
+            return
+        sock.setblocking(False)
+        self.sock, self.fd = sock, sock.fileno()
+        return 'netlink'
+
+    def polling(self):
+        """ fallback - compare /proc/bus/input/devices content periodically """
+        self.ref, self.last = self.devices(), time.time()
+        return 'polling'
+
+    def devices(self):
+        """ content of /proc/bus/input/devices """
+        try:
+            with open(self.proc) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def fileno(self):
+        """ fd for select, None for polling """
+        return self.fd
+
+    def timeout(self):
+        """ select timeout required by the monitor - polling period or None (wait for fd) """
+        return self.POLL if self.fd is None else None
+
+    def changed(self):
+        """ drain pending notifications, returns True if any event device has been added or removed """
+        if self.kind == 'polling':
+            now = time.time()
+            if now - self.last < self.POLL: return False
+            act, self.last = self.devices(), now
+            changed, self.ref = act != self.ref, act
+            return changed
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096) if self.kind == 'inotify' else self.sock.recv(8192)
+            except (OSError, socket.error):
+                break
+            if not data: break
+            changed = changed or self.relevant(data)
+        return changed
+
+    def relevant(self, data):
+        """ notification is about event device """
+        if self.kind == 'netlink':
+            return 'SUBSYSTEM=input' in data and '/event' in data.split('\0', 1)[0]
+        ofs, size = 0, self.INOTIFY_EVENT.size
+        while ofs + size <= len(data):
+            wd, mask, cookie, length = self.INOTIFY_EVENT.unpack_from(data, ofs)
+            if data[ofs + size:ofs + size + length].startswith('event'): return True
+            ofs += size + length
+        return False
+
+    def wait(self, timeout):
+        """ wait up to timeout [s] for device change """
+        end = time.time() + timeout
+        while True:
+            left = end - time.time()
+            if left <= 0: return False
+            if self.fd is None:
+                time.sleep(min(left, self.POLL))
+            elif not select.select([self.fd], [], [], left)[0]:
+                return False
+            if self.changed(): return True
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        elif self.fd is not None:
+            os.close(self.fd)
+        self.fd, self.sock = None, None
+
+
+class Profile:
+    """ cumulative time and call counts per pipeline stage - timing wrappers are installed only when profiling """
+
+    def __init__(self):
+        # stack of actual stages, stack path (tuple) -> [calls, inclusive time, time in nested stages]
+        self.stack, self.stats = [], {}
+        self.start = monotonic()
+
+    def wrap(self, obj, method, stage):
+        """ replace method of instance obj by timing wrapper """
+        func = getattr(obj, method)
+        def timed(*args, **kwargs):
+            self.stack.append(stage)
+            path = tuple(self.stack)
+            start = monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = monotonic() - start
+                self.stack.pop()
+                self.add(path, 1, elapsed, 0.0)
+                if self.stack: self.add(path[:-1], 0, 0.0, elapsed)
+        setattr(obj, method, timed)
+
+    def add(self, path, calls, elapsed, nested):
+        st = self.stats.get(path)
+        if st is None: st = self.stats[path] = [0, 0.0, 0.0]
+        st[0] += calls
+        st[1] += elapsed
+        st[2] += nested
+
+    def stages(self):
+        """ [(stage, calls, inclusive, self time)] sorted by self time """
+        stages = {}
+        for path,(calls,elapsed,nested) in self.stats.items():
+            st = stages.setdefault(path[-1], [0, 0.0, 0.0])
+            st[0] += calls
+            st[1] += elapsed
+            st[2] += elapsed - nested
+        return sorted([ (stage,) + tuple(st) for stage,st in stages.items() ], key=lambda st: -st[3])
+
+    def breakdown(self):
+        """ breakdown per stage as text lines """
+        wall = monotonic() - self.start
+        lines = [ "PROFILE = wall time: %.1f ms = stage: calls / inclusive / self time / avg per call / share of wall time"
+                  % (1000 * wall) ]
+        for stage,calls,elapsed,own in self.stages():
+            lines.append("%-8s %8d / %9.2f ms / %9.2f ms / %7.2f us / %5.1f%%" \
+                         % (stage, calls, 1000 * elapsed, 1000 * own, 1e6 * elapsed / calls if calls else 0, 100 * own / wall))
+        return lines
+
+    def save(self, fname, root='kbd-tst'):
+        """ collapsed stack file for flame graph tools (self time in us per stack, idle is the rest of wall time) """
+        wall = monotonic() - self.start
+        busy = sum([ elapsed for path,(calls,elapsed,nested) in self.stats.items() if len(path) == 1 ])
+        with open(fname, 'w') as f:
+            for path,(calls,elapsed,nested) in sorted(self.stats.items()):
+                f.write("%s %d\n" % (';'.join((root,) + path), round(1e6 * (elapsed - nested))))
+            f.write("%s;idle %d\n" % (root, round(1e6 * max(0.0, wall - busy))))
+
+
+class Signals:
+    """ signals delivered through self-pipe (signal.set_wakeup_fd) so a single select wakes up on them """
+
+    def __init__(self, signums):
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # signals received since the last check
+        self.pending = set()
+        self.saved = {}
+        for signum in signums:
+            self.saved[signum] = signal.signal(signum, self.handler)
+            # restart interrupted reads (subprocess communicate), select is interrupted anyway
+            signal.siginterrupt(signum, False)
+        signal.set_wakeup_fd(self.wfd)
+
+    def handler(self, signum, frame):
+        self.pending.add(signum)
+
+    def fileno(self):
+        return self.rfd
+
+    def received(self):
+        """ set of signals received since the last call (drains the pipe) """
+        try:
+            while os.read(self.rfd, 512): pass
+        except OSError:
+            pass
+        received, self.pending = self.pending, set()
+        return received
+
+    def close(self):
+        """ restore original handlers """
+        signal.set_wakeup_fd(-1)
+        for signum,handler in self.saved.items():
+            signal.signal(signum, handler)
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+class Keymap:
+    """ live keymap - key names <-> X keycodes discovered from 'xmodmap -pke' (X) or kernel KEY_* names (evdev), names
+        not found are taken from hard-coded Layout.rev_xmodmap, discovered keymap is cached on disk by keymap hash """
+
+    # keymap cache format version
+    VERSION = 1
+
+    # kernel key codes header
+    HEADER = '/usr/include/linux/input-event-codes.h'
+
+    # X keysym -> shorter layout label (as rev_xmodmap.sh translates), the keysym itself is kept as well
+    SHORT = {
+        'Escape': 'ESC', 'BackSpace': 'BS', 'Tab': 'TAB', 'Return': 'RET', 'space': 'SPACEBAR',
+        'minus': '-', 'equal': '=', 'bracketleft': '[', 'bracketright': ']',
+        'Control_L': 'LCTR', 'Shift_L': 'LSHIFT', 'Alt_L': 'LALT',
+        'Control_R': 'RCTR', 'Shift_R': 'RSHIFT', 'Alt_R': 'RALT',
+        'semicolon': ';', 'apostrophe': "'", 'grave': '`', 'backslash': '\\', 'comma': ',',
+        'period': '.', 'slash': '/', 'Multi_key': 'CAPS', 'Caps_Lock': 'CAPS',
+        'Print': 'PSCR', 'Scroll_Lock': 'SCRL', 'Pause': 'PAUS', 'Num_Lock': 'NUML',
+        'KP_Subtract': '_-', 'KP_Add': '_+', 'KP_Delete': '_.', 'KP_Divide': '_/', 'KP_Equal': '_=', 'KP_Multiply': '_*',
+        'KP_Enter': 'ENT',
+        'KP_Home': '_7', 'KP_Up': '_8', 'KP_Prior': '_9', 'KP_Left': '_4', 'KP_Begin': '_5', 'KP_Right': '_6',
+        'KP_End': '_1', 'KP_Down': '_2', 'KP_Next': '_3', 'KP_Insert': '_0',
+        'Home': 'HOME', 'End': 'END', 'Up': 'UP', 'Down': 'DOWN', 'Prior': 'PGUP', 'Next': 'PGDN', 'Left': 'LEFT',
+        'Right': 'RIGHT', 'Insert': 'INS', 'Delete': 'DEL',
+        'Super_L': 'LAPPLE', 'Super_R': 'RAPPLE', 'XF86Tools': 'F13', 'XF86Launch5': 'F14', 'XF86Launch6': 'F15'
+    }
+
+    # kernel KEY_* name -> layout label (letters, digits and function keys are derived from the name)
+    KERNEL = {
+        'KEY_ESC': 'ESC', 'KEY_BACKSPACE': 'BS', 'KEY_TAB': 'TAB', 'KEY_ENTER': 'RET', 'KEY_SPACE': 'SPACEBAR',
+        'KEY_MINUS': '-', 'KEY_EQUAL': '=', 'KEY_LEFTBRACE': '[', 'KEY_RIGHTBRACE': ']',
+        'KEY_LEFTCTRL': 'LCTR', 'KEY_LEFTSHIFT': 'LSHIFT', 'KEY_LEFTALT': 'LALT',
+        'KEY_RIGHTCTRL': 'RCTR', 'KEY_RIGHTSHIFT': 'RSHIFT', 'KEY_RIGHTALT': 'RALT',
+        'KEY_SEMICOLON': ';', 'KEY_APOSTROPHE': "'", 'KEY_GRAVE': '`', 'KEY_BACKSLASH': '\\', 'KEY_COMMA': ',',
+        'KEY_DOT': '.', 'KEY_SLASH': '/', 'KEY_CAPSLOCK': 'CAPS',
+        'KEY_SYSRQ': 'PSCR', 'KEY_SCROLLLOCK': 'SCRL', 'KEY_PAUSE': 'PAUS', 'KEY_NUMLOCK': 'NUML',
+        'KEY_KPMINUS': '_-', 'KEY_KPPLUS': '_+', 'KEY_KPDOT': '_.', 'KEY_KPSLASH': '_/', 'KEY_KPEQUAL': '_=',
+        'KEY_KPASTERISK': '_*', 'KEY_KPENTER': 'ENT',
+        'KEY_KP7': '_7', 'KEY_KP8': '_8', 'KEY_KP9': '_9', 'KEY_KP4': '_4', 'KEY_KP5': '_5', 'KEY_KP6': '_6',
+        'KEY_KP1': '_1', 'KEY_KP2': '_2', 'KEY_KP3': '_3', 'KEY_KP0': '_0',
+        'KEY_HOME': 'HOME', 'KEY_END': 'END', 'KEY_UP': 'UP', 'KEY_DOWN': 'DOWN', 'KEY_PAGEUP': 'PGUP',
+        'KEY_PAGEDOWN': 'PGDN', 'KEY_LEFT': 'LEFT', 'KEY_RIGHT': 'RIGHT', 'KEY_INSERT': 'INS', 'KEY_DELETE': 'DEL',
+        'KEY_LEFTMETA': 'LAPPLE', 'KEY_RIGHTMETA': 'RAPPLE'
+    }
+
+    # media keys which do not generate xinput events (apple keyboard) - labeled only for evdev, with xinput they stay
+    # missing keycodes so the test can still end with warning
+    MEDIA = { 'KEY_MUTE': 'MUTE', 'KEY_VOLUMEDOWN': 'VOL-', 'KEY_VOLUMEUP': 'VOL+', 'KEY_EJECTCD': 'EJECT' }
+
+    def __init__(self, evdev=False, cache=None):
+        """ discover keymap - xmodmap for X keycodes, kernel names for evdev or if xmodmap is not available """
+        self.cache = cache or LayoutCache()
+        self.evdev = bool(evdev)
+        dump = '' if evdev else self.xmodmap()
+        header = self.header_stamp() if evdev or not dump else None
+        self.source = ' + '.join([ name for name,used in (('xmodmap', dump), ('kernel', header), ('built-in', True)) if used ])
+        # the hash covers everything the mapping is built from
+        self.hash = hashlib.md5(repr((self.VERSION, self.evdev, dump, header, sorted(self.SHORT.items()),
+                                      sorted(self.KERNEL.items()), sorted(self.MEDIA.items()),
+                                      sorted(Layout.rev_xmodmap.items())))).hexdigest()
+        entry = self.load()
+        if entry is None:
+            entry = self.build(dump, header)
+            self.save(entry)
+        # name -> keycode, keycode -> all names
+        self.names, self.syms = entry['names'], entry['syms']
+
+    def xmodmap(self):
+        """ 'xmodmap -pke' output, empty if there is no X display or xmodmap """
+        try:
+            xmodmap = subprocess.Popen(['xmodmap', '-pke'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (stdout,stderr) = xmodmap.communicate()
+        except OSError:
+            return ''
+        return stdout if xmodmap.returncode == 0 else ''
+
+    def header_stamp(self):
+        """ validity stamp of kernel header, None if not available """
+        try:
+            st = os.stat(self.HEADER)
+        except OSError:
+            return None
+        return (self.HEADER, st.st_mtime, st.st_size)
+
+    def parse_xmodmap(self, dump):
+        """ (keycode, [keysyms]) from lines like: keycode  15 = 6 asciicircum 6 asciicircum """
+        for line in dump.splitlines():
+            words = line.split()
+            if len(words) < 4 or words[0] != 'keycode' or words[2] != '=': continue
+            yield int(words[1]), [ sym for sym in words[3:] if sym != 'NoSymbol' ]
+
+    def parse_header(self):
+        """ (X keycode, KEY_* name) from kernel header, X keycode = evdev code + 8 """
+        with open(self.HEADER) as f:
+            for m in re.finditer(r'^#define\s+(KEY_\w+)\s+(0x[0-9a-fA-F]+|\d+)\s*$', f.read(), re.M):
+                keycode = int(m.group(2), 0) + Evdev.XOFFSET
+                if keycode < Layout.KEYCODES: yield keycode, m.group(1)
+
+    def kernel_label(self, name):
+        """ layout label for kernel KEY_* name """
+        if name in self.KERNEL: return self.KERNEL[name]
+        if self.evdev and name in self.MEDIA: return self.MEDIA[name]
+        short = name[len('KEY_'):]
+        if len(short) == 1 and short.isalpha(): return short.lower()
+        if short.isdigit() or re.match(r'F\d+$', short): return short
+
+    def build(self, dump, header):
+        """ all names of all keycodes, a name shared by more keycodes resolves to the first by priority:
+            source (xmodmap, kernel, built-in), own name before shorter label, keysym level, keycode """
+        names = []
+        for keycode,syms in self.parse_xmodmap(dump):
+            for level,sym in enumerate(syms):
+                names.append((0, 0, level, keycode, sym))
+                if sym in self.SHORT: names.append((0, 1, level, keycode, self.SHORT[sym]))
+        if header:
+            for keycode,name in self.parse_header():
+                names.append((1, 0, 0, keycode, name))
+                label = self.kernel_label(name)
+                if label: names.append((1, 1, 0, keycode, label))
+        for name,keycode in Layout.rev_xmodmap.items():
+            names.append((2, 0, 0, keycode, name))
+        names.sort()
+        entry = { 'names': {}, 'syms': {} }
+        for source,short,level,keycode,name in names:
+            entry['names'].setdefault(name, keycode)
+            syms = entry['syms'].setdefault(keycode, [])
+            if name not in syms: syms.append(name)
+        return entry
+
+    def fname(self):
+        """ cache file for this keymap """
+        return os.path.join(self.cache.dir, self.hash + '.kmap')
+
+    def load(self):
+        try:
+            with open(self.fname(), 'rb') as f:
+                entry = marshal.load(f)
+            if entry['hash'] == self.hash: return entry
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+            pass
+
+    def save(self, entry):
+        """ store keymap (atomic replace), cache errors are ignored """
+        entry['hash'] = self.hash
+        fname = self.fname()
+        try:
+            if not os.path.isdir(self.cache.dir): os.makedirs(self.cache.dir)
+            with open(fname + '.tmp', 'wb') as f:
+                marshal.dump(entry, f)
+            os.rename(fname + '.tmp', fname)
+        except (IOError, OSError):
+            pass
+
+    def keycode(self, name):
+        """ keycode of key name or None """
+        return self.names.get(name)
+
+    def keysyms(self, keycode):
+        """ all names of keycode (the most specific first) """
+        return self.syms.get(keycode, [])
+
+
+class Layout:
+    """ keyboard layout """
+
+    # fallback reverse xmodmap -pk if there is no live keymap (use rev_xmodmap.sh for possible updates)
+    # key -> keycode
+    rev_xmodmap = {
+        'ESC': 9,
+        '1': 10,
+        '2': 11,
+        '3': 12,
+        '4': 13,
+        '5': 14,
+        '6': 15,
+        '7': 16,
+        '8': 17,
+        '9': 18,
+        '0': 19,
+        '-': 20,
+        '=': 21,
+        'BS': 22,
+        'TAB': 23,
+        'q': 24,
+        'w': 25,
+        'e': 26,
+        'r': 27,
+        't': 28,
+        'y': 29,
+        'u': 30,
+        'i': 31,
+        'o': 32,
+        'p': 33,
+        '[': 34,
+        ']': 35,
+        'RET': 36,
+        'LCTR': 37,
+        'a': 38,
+        's': 39,
+        'd': 40,
+        'f': 41,
+        'g': 42,
+        'h': 43,
+        'j': 44,
+        'k': 45,
+        'l': 46,
+        ';': 47,
+        "'": 48,
+        '`': 49,
+        'LSHIFT': 50,
+        '\\': 51,
+        'z': 52,
+        'x': 53,
+        'c': 54,
+        'v': 55,
+        'b': 56,
+        'n': 57,
+        'm': 58,
+        ',': 59,
+        '.': 60,
+        '/': 61,
+        'RSHIFT': 62,
+        '_*': 63,
+        'LALT': 64,
+        'SPACEBAR': 65,
+        'CAPS': 66,
+        'F1': 67,
+        'F2': 68,
+        'F3': 69,
+        'F4': 70,
+        'F5': 71,
+        'F6': 72,
+        'F7': 73,
+        'F8': 74,
+        'F9': 75,
+        'F10': 76,
+        'NUML': 77,
+        'SCRL': 78,
+        '_7': 79,
+        '_8': 80,
+        '_9': 81,
+        '_-': 82,
+        '_4': 83,
+        '_5': 84,
+        '_6': 85,
+        '_+': 86,
+        '_1': 87,
+        '_2': 88,
+        '_3': 89,
+        '_0': 90,
+        '_.': 91,
+        'ISO_Level3_Shift': 92,
+        'less': 94,
+        'F11': 95,
+        'F12': 96,
+        'Katakana': 98,
+        'Hiragana': 99,
+        'Henkan_Mode': 100,
+        'XF86LaunchD': 101,
+        'Muhenkan': 102,
+        'ENT': 104,
+        'RCTR': 105,
+        '_/': 106,
+        'PSCR': 107,
+        'RALT': 108,
+        'Linefeed': 109,
+        'HOME': 110,
+        'UP': 111,
+        'PGUP': 112,
+        'LEFT': 113,
+        'RIGHT': 114,
+        'END': 115,
+        'DOWN': 116,
+        'PGDN': 117,
+        'INS': 118,
+        'DEL': 119,
+        'XF86AudioMute': 121,
+        'XF86AudioLowerVolume': 122,
+        'XF86AudioRaiseVolume': 123,
+        'XF86PowerOff': 124,
+        '_=': 125,
+        'plusminus': 126,
+        'PAUS': 127,
+        'XF86LaunchA': 128,
+        'KP_Decimal': 129,
+        'Hangul': 130,
+        'Hangul_Hanja': 131,
+        'XF86LightBulb': 132,
+        'LAPPLE': 133,
+        'RAPPLE': 134,
+        'Menu': 135,
+        'Cancel': 136,
+        'Redo': 137,
+        'SunProps': 138,
+        'Undo': 139,
+        'SunFront': 140,
+        'XF86Copy': 141,
+        'XF86Open': 142,
+        'XF86Paste': 143,
+        'XF86AudioPrev': 144,
+        'XF86Cut': 145,
+        'Help': 146,
+        'XF86MenuKB': 147,
+        'XF86Calculator': 148,
+        'XF86Sleep': 150,
+        'XF86WakeUp': 151,
+        'XF86Explorer': 152,
+        'XF86AudioNext': 153,
+        'XF86Xfer': 155,
+        'XF86Launch1': 156,
+        'XF86Launch2': 157,
+        'XF86WWW': 158,
+        'XF86AudioPause': 162,
+        'XF86Mail': 163,
+        'XF86AudioStop': 164,
+        'XF86Back': 166,
+        'XF86Forward': 167,
+        'XF86Eject': 169,
+        'XF86AudioPlay': 172,
+        'XF86AudioRecord': 175,
+        'XF86Phone': 177,
+        'XF86HomePage': 180,
+        'XF86Reload': 181,
+        'XF86Close': 182,
+        'XF86ScrollUp': 185,
+        'XF86ScrollDown': 186,
+        'parenleft': 187,
+        'parenright': 188,
+        'XF86New': 189,
+        'F13': 191,
+        'F14': 192,
+        'F15': 193,
+        'XF86Launch7': 194,
+        'XF86Launch8': 195,
+        'XF86Launch9': 196,
+        'XF86AudioMicMute': 198,
+        'XF86TouchpadToggle': 199,
+        'XF86TouchpadOn': 200,
+        'XF86TouchpadOff': 201,
+        'Mode_switch': 203,
         'XF86LaunchC': 205,
-        'XF86AudioPlay': 208,
-        'XF86AudioPAUS': 209,
         'XF86Launch3': 210,
         'XF86Launch4': 211,
         'XF86LaunchE': 212,
         'XF86Suspend': 213,
-        'XF86Close': 214,
-        'XF86AudioPlay': 215,
         'XF86AudioForward': 216,
         'XF86WebCam': 220,
         'XF86Standby': 223,
@@ -533,16 +1724,12 @@ class Layout:
         'XF86Go': 226,
         'XF86Finance': 227,
         'XF86Game': 228,
-        'XF86Search': 229,
         'XF86Favorites': 230,
         'XF86Refresh': 231,
         'XF86Stop': 232,
-        'XF86Forward': 233,
-        'XF86Back': 234,
         'XF86MyComputer': 235,
-        'XF86Mail': 236,
         'XF86AudioMedia': 237,
-        'XF86KbdBrightnessUP': 238,
+        'XF86KbdBrightnessUp': 238,
         'XF86Send': 239,
         'XF86Reply': 240,
         'XF86LaunchB': 241,
@@ -554,69 +1741,1005 @@ class Layout:
         'HELP': 118,
     }
 
-    def __init__(self):
-        """ init required classes """
-        # keycode -> (row,col), key, tested
-        self.layout = {}
+    # X keycodes are 8..255
+    KEYCODES = 256
+
+    # live keymap (Keymap) discovered at startup, hard-coded rev_xmodmap is used if not set
+    keymap = None
+
+    def __init__(self):
+        """ init required classes """
+        # keycode -> (row,col), key, label, keycode
+        self.layout = {}
+        # keycode indexed key entries and states
+        self.keys = [None] * self.KEYCODES
+        self.tested = array.array('B', [0]) * self.KEYCODES
+        self.pressed = array.array('B', [0]) * self.KEYCODES
+        # running counters
+        self.ntested, self.npressed = 0, 0
+
+    def load_gmap(self, fname):
+        """ load keyboard layout from fname map file and parse it (create layout dictionary) """
+        gmap = []
+        if fname:
+            with open(fname) as f:
+                for line in f:
+                    gmap.append(line.rstrip(os.linesep))
+        return gmap
+
+    def parse_gmap(self, gmap):
+        errs = []
+        # parse map
+        for row,line in enumerate(gmap):
+            if not line: continue
+            errs += self._parse_line(line, row)
+        return errs
+
+    def _parse_line(self, line, row):
+        """ extract all keys from single line of map layout """
+        errs = []
+        for m in re.finditer(r'\[(\s+(\S+)\s+)\]', line):
+            label,key,col = m.group(1),m.group(2),m.start(1)
+            err = self._add_key(key, row, col, label)
+            if err: errs.append(err)
+        return errs
+
+    def _add_key(self, key, row, col, label):
+        """ add single key to layout dictionary """
+        # find keycode for key
+        keycode = self.key_to_keycode(key)
+        if not keycode:
+            # if not found retrtns error message
+            return "missing keycode for key [ %s ]" % key
+        # if found add to layout
+        self._set_key(keycode, row, col, key, label)
+
+    def _set_key(self, keycode, row, col, key, label):
+        """ set single key entry for keycode """
+        self.layout[keycode] = { 'row': row, 'col': col, 'key': key, 'label': label, 'keycode': keycode }
+        self.keys[keycode] = self.layout[keycode]
+
+    def keymap_hash(self):
+        """ hash of the key -> keycode mapping used to resolve layout labels """
+        if self.keymap: return self.keymap.hash
+        return hashlib.md5(repr(sorted(self.rev_xmodmap.items()))).hexdigest()
+
+    def compile(self, fname, cache=None):
+        """ load and parse layout file through compiled layout cache, returns (gmap, errs) """
+        cache = cache or LayoutCache()
+        keymap = self.keymap_hash()
+        entry = cache.load(fname, keymap) if fname else None
+        # cache hit - just set keys
+        if entry:
+            for keycode,row,col,key,label in entry['keys']:
+                self._set_key(keycode, row, col, key, label)
+            return entry['gmap'], entry['errs']
+        # cache miss or stale - parse and store
+        gmap = self.load_gmap(fname)
+        errs = self.parse_gmap(gmap)
+        if fname:
+            keys = [ (v['keycode'], v['row'], v['col'], v['key'], v['label']) for v in self.layout.values() ]
+            cache.save(fname, keymap, { 'gmap': gmap, 'keys': keys, 'errs': errs })
+        return gmap, errs
+
+    def key_to_keycode(self, key):
+        """ keymap lookup symbolic_key -> keycode """
+        if self.keymap: return self.keymap.keycode(key)
+        return self.rev_xmodmap.get(key)
+
+    def keycode_to_keysyms(self, keycode):
+        """ keymap lookup keycode -> all symbolic keys """
+        if self.keymap: return self.keymap.keysyms(keycode)
+        return sorted([ key for key,kc in self.rev_xmodmap.items() if kc == keycode ])
+
+    def keycode_to_key(self, keycode):
+        """ keycode entry from layout """
+        return self.keys[keycode] if keycode < self.KEYCODES else None
+
+    def key_action(self, keycode, action):
+        """ update key state and running counters - press / release (= tested) """
+        if action == 'press':
+            if not self.pressed[keycode]:
+                self.pressed[keycode] = 1
+                self.npressed += 1
+            return
+        if self.pressed[keycode]:
+            self.pressed[keycode] = 0
+            self.npressed -= 1
+        if not self.tested[keycode]:
+            self.tested[keycode] = 1
+            self.ntested += 1
+
+    def all_tested(self):
+        """ all keys from layout have been tested """
+        return self.ntested == len(self.layout)
+
+
+class KeyTiming:
+    """ streaming per key timing statistics - press count, dwell time histogram, minimal gap, chatter (bounce) detection """
+
+    # dwell time histogram buckets: <1 ms, 1-2 ms, 2-4 ms, ... 512-1024 ms, >= 1024 ms
+    BUCKETS = 12
+
+    def __init__(self, chatter=5.0, bounces=2, readtime=False):
+        """ gap shorter than chatter [ms] is a bounce, key with at least bounces bounces is flagged, readtime means
+            timestamps are read times (xinput) - events of a single read share the timestamp, zero gap is not a bounce """
+        self.chatter, self.bounces, self.readtime = chatter / 1000.0, int(bounces), readtime
+        n = Layout.KEYCODES
+        self.presses = array.array('L', [0]) * n
+        self.nbounces = array.array('L', [0]) * n
+        self.flagged = array.array('B', [0]) * n
+        self.down = array.array('B', [0]) * n
+        self.lastevent = array.array('d', [0.0]) * n
+        self.mingap = array.array('d', [float('inf')]) * n
+        self.dwell = array.array('L', [0]) * (n * self.BUCKETS)
+        # count of flagged keys
+        self.nflagged = 0
+
+    def bucket(self, dwell):
+        """ histogram bucket for dwell time [s] """
+        return min(self.BUCKETS - 1, int(dwell * 1000).bit_length())
+
+    def event(self, keycode, action, tstamp):
+        """ update statistics of key by single event """
+        if action == 'press':
+            # autorepeat
+            if self.down[keycode]: return
+            self.down[keycode] = 1
+            self.presses[keycode] += 1
+        else:
+            if not self.down[keycode]: return
+            self.down[keycode] = 0
+            self.dwell[keycode * self.BUCKETS + self.bucket(tstamp - self.lastevent[keycode])] += 1
+        last, self.lastevent[keycode] = self.lastevent[keycode], tstamp
+        # the very first event has no gap
+        if not last: return
+        gap = tstamp - last
+        if gap < self.mingap[keycode]: self.mingap[keycode] = gap
+        if gap < self.chatter and not (self.readtime and gap == 0):
+            self.nbounces[keycode] += 1
+            if self.nbounces[keycode] >= self.bounces and not self.flagged[keycode]:
+                self.flagged[keycode] = 1
+                self.nflagged += 1
+
+    def histogram(self, keycode):
+        """ dwell time histogram of key as text 'bucket_ms:count' of non empty buckets """
+        ofs = keycode * self.BUCKETS
+        return ' '.join([ '%s:%d' % ('<1' if b == 0 else '%d+' % (1 << (b - 1)), self.dwell[ofs + b])
+                          for b in range(self.BUCKETS) if self.dwell[ofs + b] ])
+
+    def summary(self, keycode):
+        """ key statistics as text """
+        return "presses: %d = bounces: %d = min gap: %.1f ms = dwell ms %s" \
+               % (self.presses[keycode], self.nbounces[keycode], 1000 * self.mingap[keycode], self.histogram(keycode))
+
+
+class PollRate:
+    """ USB polling rate and timing jitter estimation from kernel event timestamps (evdev) """
+
+    # candidate polling intervals [s] for 1000, 500, 250 and 125 Hz reports
+    INTERVALS = [ 0.001, 0.002, 0.004, 0.008 ]
+    # longer gap between reports is a pause in typing
+    IDLE = 0.05
+    # max mean distance of gaps from multiples of interval (as fraction of interval) to match the candidate
+    MATCH = 0.2
+    # max fraction of gaps on odd multiples of finer interval to take twice as long interval
+    OUTLIERS = 0.02
+    # min count of gaps for an estimate
+    MINGAPS = 100
+
+    def __init__(self, target=1000, capacity=4096):
+        """ target rate [Hz], the last capacity gaps are kept in ring buffer """
+        self.target = target
+        self.gaps = Ring(capacity)
+        self.last, self.mingap = 0.0, float('inf')
+
+    def event(self, tstamp):
+        """ register report timestamp, events of the same report share the timestamp """
+        if tstamp == self.last: return
+        gap, self.last = tstamp - self.last, tstamp
+        # the very first event and pauses
+        if gap <= 0 or gap > self.IDLE: return
+        self.gaps.append(gap)
+        if gap < self.mingap: self.mingap = gap
+
+    def estimate(self):
+        """ (interval, sorted jitter) for the longest candidate interval all gaps are multiples of, None if no match -
+            twice as long interval is taken only if (almost) no gap is off by half of it (odd multiple of finer one),
+            mean distance alone does not tell random human gaps at 1000 Hz from slower rates """
+        gaps, match = self.gaps.values(), None
+        for interval in self.INTERVALS:
+            jitter = sorted([ abs(gap - round(gap / interval) * interval) for gap in gaps ])
+            if match is None:
+                if sum(jitter) <= self.MATCH * interval * len(jitter): match = (interval, jitter)
+                continue
+            if len([ j for j in jitter if j > interval / 4 ]) > self.OUTLIERS * len(jitter): break
+            match = (interval, jitter)
+        return match
+
+    def status(self):
+        """ short status for footer """
+        return " Poll gaps: %d = Min gap: %.2f ms =" % (len(self.gaps), 1000 * self.mingap if self.gaps else 0)
+
+    def result(self):
+        """ (passed, text) """
+        if len(self.gaps) < self.MINGAPS:
+            return False, "POLLING RATE FAILED = only %d report gaps (min %d), mash keys faster = target %d Hz" \
+                          % (len(self.gaps), self.MINGAPS, self.target)
+        match = self.estimate()
+        if not match:
+            return False, "POLLING RATE FAILED = no stable polling interval = min gap %.2f ms = %d gaps = target %d Hz" \
+                          % (1000 * self.mingap, len(self.gaps), self.target)
+        interval, jitter = match
+        rate = 1 / interval
+        return rate >= self.target, "POLLING RATE %s = %d Hz (%.0f ms) = jitter p50 %.3f ms p99 %.3f ms max %.3f ms = " \
+               "min gap %.2f ms = %d gaps = target %d Hz" % ('PASSED' if rate >= self.target else 'FAILED', rate,
+               1000 * interval, 1000 * percentile(jitter, 0.5), 1000 * percentile(jitter, 0.99), 1000 * jitter[-1],
+               1000 * self.mingap, len(self.gaps), self.target)
+
+
+class Latency:
+    """ end-to-end latency from event timestamp (kernel or xinput read time) to flushed screen update """
+
+    # live footer figure is recomputed at most once per period [s]
+    PERIOD = 1.0
+    # negative or larger latency comes from another clock (recorded events from pipe)
+    MAX = 10.0
+
+    def __init__(self, capacity=8192):
+        """ the last capacity latencies are kept in ring buffer """
+        self.lat = Ring(capacity)
+        self.count, self.skipped = 0, 0
+        self.live, self.lastlive = '', 0.0
+
+    def flushed(self, tstamps, now):
+        """ events with timestamps tstamps are on screen at monotonic time now """
+        for tstamp in tstamps:
+            lat = now - tstamp
+            if 0 <= lat <= self.MAX:
+                self.lat.append(lat)
+                self.count += 1
+            else:
+                self.skipped += 1
+
+    def percentiles(self, qs):
+        """ latency percentiles [s] of kept values """
+        lat = sorted(self.lat.values())
+        return [ percentile(lat, q) for q in qs ]
+
+    def status(self):
+        """ short status for footer - p50/p99 of the last latencies """
+        now = time.time()
+        if len(self.lat) and now - self.lastlive >= self.PERIOD:
+            self.live = " Latency p50/p99: %.1f/%.1f ms =" % tuple([ 1000 * p for p in self.percentiles([0.5, 0.99]) ])
+            self.lastlive = now
+        return self.live
+
+    def summary(self):
+        """ result as text """
+        if not len(self.lat): return "LATENCY event -> screen = no events (skipped %d with foreign timestamps)" % self.skipped
+        p = [ 1000 * v for v in self.percentiles([0.5, 0.9, 0.99, 0.999, 1.0]) ]
+        return "LATENCY event -> screen = events: %d = p50 %.2f ms p90 %.2f ms p99 %.2f ms p999 %.2f ms max %.2f ms" \
+               " = skipped: %d" % tuple([ self.count ] + p + [ self.skipped ])
+
+
+class Rollover:
+    """ N-key rollover and ghosting test - held keys as bitset over keycodes, chord patterns prompted on layout """
+
+    # standard chord patterns (name, keys), ghost square prompts 3 corners of key matrix rectangle
+    PATTERNS = [
+        ('shift + key',   ['LSHIFT', 'a']),
+        ('modifiers',     ['LCTR', 'LSHIFT', 'LALT', 'RALT', 'RSHIFT', 'RCTR']),
+        ('6KRO home row', ['a', 's', 'd', 'f', 'j', 'k']),
+        ('ghost square',  ['q', 'w', 'a']),
+        ('ghost square',  ['z', 'x', 's']),
+        ('NKRO top row',  ['q', 'w', 'e', 'r', 't', 'y', 'u', 'i', 'o', 'p'])
+    ]
+
+    def __init__(self, layout):
+        """ use only patterns with all keys present in layout """
+        self.patterns = []
+        for name,keys in self.PATTERNS:
+            keycodes = [ layout.key_to_keycode(key) for key in keys ]
+            if all([ kc and layout.keycode_to_key(kc) for kc in keycodes ]): self.patterns.append((name, keys, keycodes))
+        # held keys bitset and count, max registered chord
+        self.held, self.nheld, self.maxchord = 0, 0, 0
+        # ghost keys bitset and count
+        self.ghosts, self.nghosts = 0, 0
+        # (name, registered, size) of finished patterns
+        self.results = []
+        self.index = -1
+        self.next_pattern()
+
+    def next_pattern(self):
+        """ advance to the next chord pattern """
+        self.index += 1
+        keycodes = self.pattern()[2] if not self.done() else []
+        self.pmask = sum([ 1 << kc for kc in keycodes ])
+        # pattern keys held now and max of them held at once
+        self.inchord, self.peak = 0, 0
+
+    def pattern(self):
+        """ actual (name, keys, keycodes) """
+        return self.patterns[self.index]
+
+    def done(self):
+        return self.index >= len(self.patterns)
+
+    def event(self, keycode, action):
+        """ update held set by single event, returns True if actual pattern has been finished (all keys released after
+            the whole chord or at least 2 of its keys have been held together) """
+        bit = 1 << keycode
+        if action == 'press':
+            # autorepeat
+            if self.held & bit: return False
+            self.held |= bit
+            self.nheld += 1
+            if self.nheld > self.maxchord: self.maxchord = self.nheld
+            if self.pmask & bit:
+                self.inchord += 1
+                if self.inchord > self.peak: self.peak = self.inchord
+            elif self.inchord >= 2 and not self.ghosts & bit:
+                # key outside of prompted chord appeared while the chord is held
+                self.ghosts |= bit
+                self.nghosts += 1
+            return False
+        if not self.held & bit: return False
+        self.held &= ~bit
+        self.nheld -= 1
+        if self.pmask & bit: self.inchord -= 1
+        # pattern is finished when everything is released
+        if self.nheld or not self.peak or self.done(): return False
+        # single prompted key tapped (key by key testing) - not a chord attempt, keep prompting the same chord
+        if self.peak < 2 and self.peak < len(self.pattern()[2]):
+            self.peak = 0
+            return False
+        self.results.append((self.pattern()[0], self.peak, len(self.pattern()[2])))
+        self.next_pattern()
+        return True
+
+    def is_ghost(self, keycode):
+        return bool(self.ghosts >> keycode & 1)
+
+    def failed(self):
+        """ count of patterns not fully registered """
+        return len([ r for r in self.results if r[1] < r[2] ])
+
+    def status(self):
+        """ short status for footer """
+        prompt = 'done' if self.done() else '%s [ %s ] %d/%d' \
+                 % (self.pattern()[0], ' '.join(self.pattern()[1]), self.inchord, len(self.pattern()[2]))
+        return " Rollover: %s = Max chord: %d = Ghosts: %d =" % (prompt, self.maxchord, self.nghosts)
+
+    def summary(self):
+        """ result as text """
+        res = ' / '.join([ '%s %d/%d' % r for r in self.results ])
+        return "ROLLOVER = max chord: %d = patterns passed: %d of %d = ghost keys: %d = %s" \
+               % (self.maxchord, len(self.results) - self.failed(), len(self.patterns), self.nghosts, res)
+
+
+class LayoutCache:
+    """ compiled layout files cache on disk keyed by file path, mtime and keymap hash """
+
+    # cache format version
+    VERSION = 1
+
+    # entries already loaded by this process (daemon, station): cache file -> entry
+    loaded = {}
+
+    def __init__(self, dir=None):
+        """ cache directory, default ~/.cache/kbd-tst """
+        self.dir = dir or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'kbd-tst')
+
+    def fname(self, path):
+        """ cache file for layout file path """
+        return os.path.join(self.dir, hashlib.md5(os.path.abspath(path)).hexdigest() + '.layc')
+
+    def stamp(self, path, keymap):
+        """ validity stamp of layout file path """
+        st = os.stat(path)
+        return (self.VERSION, os.path.abspath(path), st.st_mtime, st.st_size, keymap)
+
+    def load(self, path, keymap):
+        """ compiled layout entry or None if not cached or stale (already loaded entries are not read again) """
+        fname = self.fname(path)
+        try:
+            entry = self.loaded.get(fname)
+            if entry is None:
+                with open(fname, 'rb') as f:
+                    entry = marshal.load(f)
+            if entry['stamp'] == self.stamp(path, keymap):
+                self.loaded[fname] = entry
+                return entry
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+            pass
+
+    def save(self, path, keymap, entry):
+        """ store compiled layout entry (atomic replace), cache errors are ignored """
+        entry['stamp'] = self.stamp(path, keymap)
+        fname = self.fname(path)
+        self.loaded[fname] = entry
+        try:
+            if not os.path.isdir(self.dir): os.makedirs(self.dir)
+            with open(fname + '.tmp', 'wb') as f:
+                marshal.dump(entry, f)
+            os.rename(fname + '.tmp', fname)
+        except (IOError, OSError):
+            pass
+
+
+class LayoutIndex:
+    """ inverted index keycode -> bitmask of layout files containing it, built over layout dirs and cached on disk """
+
+    # index format version
+    VERSION = 1
+
+    def __init__(self, dirs, cache=None):
+        """ index all *.lay files in dirs """
+        self.cache = cache or LayoutCache()
+        self.files = sorted(set([ os.path.abspath(os.path.join(d, f)) for d in dirs if os.path.isdir(d)
+                                  for f in os.listdir(d) if f.endswith('.lay') ]))
+        self.keymap = Layout().keymap_hash()
+        stamp = self.stamp()
+        entry = self.load(stamp)
+        if entry is None:
+            entry = self.build()
+            self.save(stamp, entry)
+        # layout files sorted by count of keys, keycode -> bitmask of layout numbers
+        self.files, self.index = entry['files'], entry['index']
+
+    def stamp(self):
+        """ validity stamp - all layout files with mtime and size, keymap hash """
+        files = []
+        for f in self.files:
+            st = os.stat(f)
+            files.append((f, st.st_mtime, st.st_size))
+        return (self.VERSION, self.keymap, tuple(files))
+
+    def fname(self):
+        """ cache file for this set of layout files """
+        return os.path.join(self.cache.dir, hashlib.md5(repr(self.files)).hexdigest() + '.layx')
+
+    def build(self):
+        """ compile all layouts (through compiled layout cache) and invert keycode sets, smaller layouts first """
+        keycodes = []
+        for f in self.files:
+            layout = Layout()
+            layout.compile(f, self.cache)
+            keycodes.append((len(layout.layout), f, layout.layout.keys()))
+        keycodes.sort()
+        index = {}
+        for i,(size,f,kcs) in enumerate(keycodes):
+            for keycode in kcs:
+                index[keycode] = index.get(keycode, 0) | (1 << i)
+        return { 'files': [ f for size,f,kcs in keycodes ], 'index': index }
+
+    def load(self, stamp):
+        try:
+            with open(self.fname(), 'rb') as f:
+                entry = marshal.load(f)
+            if entry['stamp'] == stamp: return entry
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+            pass
+
+    def save(self, stamp, entry):
+        """ store index (atomic replace), cache errors are ignored """
+        entry['stamp'] = stamp
+        fname = self.fname()
+        try:
+            if not os.path.isdir(self.cache.dir): os.makedirs(self.cache.dir)
+            with open(fname + '.tmp', 'wb') as f:
+                marshal.dump(entry, f)
+            os.rename(fname + '.tmp', fname)
+        except (IOError, OSError):
+            pass
+
+
+class LayoutRank:
+    """ incremental ranking of indexed layouts by count of distinct pressed keycodes they contain - hit counters of all
+        layouts are bit sliced into bitmask planes so each keycode costs a few big integer operations """
+
+    def __init__(self, index, layout):
+        """ layout is the actual layout (it does not have to be indexed) """
+        self.index = index
+        self.seen = array.array('B', [0]) * Layout.KEYCODES
+        # plane j has bit i set if bit j of hit counter of layout i is set
+        self.planes = []
+        # distinct keycodes pressed, of them found in actual layout
+        self.observed, self.current = 0, 0
+        # the best layout number and its hits
+        self.best, self.besthits = None, 0
+        self.layout = layout
+
+    def event(self, keycode):
+        """ count keycode if not seen yet, returns True if ranking has changed """
+        if self.seen[keycode]: return False
+        self.seen[keycode] = 1
+        self.observed += 1
+        if self.layout.keycode_to_key(keycode): self.current += 1
+        # add 1 to counters of all layouts containing keycode at once (ripple carry over planes)
+        carry, j = self.index.index.get(keycode, 0), 0
+        while carry:
+            if j == len(self.planes): self.planes.append(0)
+            plane = self.planes[j]
+            self.planes[j], carry = plane ^ carry, plane & carry
+            j += 1
+        self.rank()
+        return True
+
+    def rank(self):
+        """ layouts with max hits from the highest plane down, the first is the smallest (layouts are sorted by size) """
+        cand = (1 << len(self.index.files)) - 1
+        for plane in reversed(self.planes):
+            if cand & plane: cand &= plane
+        self.best = (cand & -cand).bit_length() - 1 if cand else None
+        self.besthits = 0 if self.best is None else self.hits(self.best)
+
+    def hits(self, i):
+        """ hit counter of layout number i """
+        return sum([ ((plane >> i) & 1) << j for j,plane in enumerate(self.planes) ])
+
+    def set_layout(self, layout):
+        """ actual layout has been switched """
+        self.layout = layout
+        self.current = len([ kc for kc in range(Layout.KEYCODES) if self.seen[kc] and layout.keycode_to_key(kc) ])
+
+    def suggestion(self):
+        """ (file, hits) of best layout if it matches more pressed keys than actual layout, None otherwise """
+        if self.best is None or self.besthits <= self.current: return None
+        return self.index.files[self.best], self.besthits
+
+
+class ResultsDB:
+    """ test sessions and per key results in SQLite database (WAL mode - several stations can write at once) """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY, started REAL, ended REAL, device TEXT, devid TEXT, layout TEXT,
+            result TEXT, total INTEGER, tested INTEGER, missing INTEGER);
+        CREATE TABLE IF NOT EXISTS keys (
+            session INTEGER, keycode INTEGER, key TEXT, tested INTEGER, failed INTEGER,
+            presses INTEGER, bounces INTEGER, mingap REAL, chatter INTEGER,
+            PRIMARY KEY (session, keycode)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS sessions_layout ON sessions (layout, started);
+        CREATE INDEX IF NOT EXISTS sessions_device ON sessions (device, started);
+        CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started);
+        CREATE INDEX IF NOT EXISTS keys_failed ON keys (key, session) WHERE failed = 1;
+    """
+
+    def __init__(self, path):
+        """ open (create) database, writers wait up to 30s for the lock """
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+
+    def save(self, tst):
+        """ store finished test session with all keys in single transaction """
+        summary = tst.summary(tst.results())
+        timing = tst.timing
+        with self.conn:
+            cur = self.conn.execute('INSERT INTO sessions (started, ended, device, devid, layout, result, total, tested, '
+                                    'missing) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (tst.started, time.time(), summary['device'], str(summary['id']), summary['layout'],
+                                     summary['result'], summary['total'], summary['tested'], summary['missing']))
+            session = cur.lastrowid
+            self.conn.executemany('INSERT INTO keys VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [ (session, keycode, keydict['key'], tst.layout.tested[keycode],
+                   int(not tst.layout.tested[keycode] or timing.flagged[keycode]),
+                   timing.presses[keycode], timing.nbounces[keycode],
+                   None if timing.mingap[keycode] == float('inf') else timing.mingap[keycode], timing.flagged[keycode])
+                  for keycode,keydict in tst.layout.layout.items() ])
+        return session
 
-    def load_gmap(self, fname):
-        """ load keyboard layout from fname map file and parse it (create layout dictionary) """
-        gmap = []
-        if fname:
-            with open(fname) as f:
-                for line in f:
-                    gmap.append(line.rstrip(os.linesep))
-        return gmap
+    def failing_keys(self, device=None, limit=20):
+        """ [(key, fails)] keys failing most (untested or chattering) on device model or on all devices """
+        if device is None:
+            return self.conn.execute('SELECT key, COUNT(*) AS fails FROM keys WHERE failed = 1 '
+                                     'GROUP BY key ORDER BY fails DESC, key LIMIT ?', (limit,)).fetchall()
+        return self.conn.execute('SELECT k.key, COUNT(*) AS fails FROM sessions s JOIN keys k ON k.session = s.id '
+                                 'WHERE s.device = ? AND k.failed = 1 GROUP BY k.key ORDER BY fails DESC, k.key LIMIT ?',
+                                 (device, limit)).fetchall()
 
-    def parse_gmap(self, gmap):
-        errs = []
-        # parse map
-        for row,line in enumerate(gmap):
-            if not line: continue
-            errs += self._parse_line(line, row)
-        return errs
+    def sessions(self, device=None):
+        """ count of sessions of device model or all """
+        if device is None: return self.conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+        return self.conn.execute('SELECT COUNT(*) FROM sessions WHERE device = ?', (device,)).fetchone()[0]
 
-    def _parse_line(self, line, row):
-        """ extract all keys from single line of map layout """
-        errs = []
-        for m in re.finditer(r'\[(\s+(\S+)\s+)\]', line):
-            label,key,col = m.group(1),m.group(2),m.start(1)
-            err = self._add_key(key, row, col, label)
-            if err: errs.append(err)
-        return errs
+    def query(self, device=None):
+        """ print keys failing most on device model (or on all devices) """
+        total = self.sessions(device)
+        print "= Keys failing most on [ %s ] = sessions: %d =" % (device or 'all devices', total)
+        for key,fails in self.failing_keys(device):
+            print "    %-10s fails: %6d = %5.1f%%" % (key, fails, 100.0 * fails / total)
 
-    def _add_key(self, key, row, col, label, tested=False):
-        """ add single key to layout dictionary """
-        # find keycode for key
-        keycode = self.key_to_keycode(key)
-        if not keycode:
-            # if not found retrtns error message
-            return "missing keycode for key [ %s ]" % key
-        # if found add to layout
-        self.layout[keycode] = { 'row': row, 'col': col, 'key': key, 'label': label, 'tested': tested }
+    def close(self):
+        self.conn.close()
 
-    def key_to_keycode(self, key):
-        """ reverse xmodmap mapping lookup symbolic_key -> keycode """
-        return self.rev_xmodmap.get(key)
 
-    def keycode_to_key(self, keycode):
-        """ keycode entry from layout dictionary """
-        return self.layout.get(keycode)
+class Dashboard:
+    """ live dashboard for supervisors - embedded HTTP server on localhost port (or Unix socket) streams key states,
+        footer stats and messages of all sessions as server-sent events, snapshot when viewer connects then deltas;
+        sessions only record changes, serving and fan-out to viewers run in own thread """
+
+    # default localhost port
+    PORT = 8088
+    # fan-out period [s], max changes between fan-outs, max batches queued per viewer, messages kept per session
+    PERIOD, PENDING, QUEUE, MESSAGES = 0.05, 8192, 64, 5
+
+    PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>kbd-tst dashboard</title><style>
+body { background: #111; color: #ccc; font: 13px monospace; }
+pre { margin: 4px 0; } h3 { margin: 16px 0 0; color: #fff; }
+.press { background: #c00; color: #000; } .release { background: #0a0; color: #000; }
+.prompt { background: #cc0; color: #000; } .ghost { background: #c0c; color: #fff; }
+.msg span { color: #000; padding: 0 4px; } .stats { color: #0cc; }
+</style></head><body><div id="sessions"></div><script>
+var S = {};
+function esc(t) { return t.replace(/&/g, '&amp;').replace(/</g, '&lt;'); }
+function draw(sid) {
+  var s = S[sid], el = document.getElementById('s-' + sid);
+  if (!el) { el = document.createElement('div'); el.id = 's-' + sid; document.getElementById('sessions').appendChild(el); }
+  var lines = s.map.map(function(line) { return line.split('').map(esc); });
+  for (var pos in s.keys) {
+    var rc = pos.split(','), r = +rc[0], c = +rc[1], w = s.cells[pos], line = lines[r];
+    if (!line || !w) continue;
+    while (line.length < c + w) line.push(' ');
+    line[c] = '<span class="' + s.keys[pos] + '">' + line[c]; line[c + w - 1] += '</span>';
+  }
+  var st = s.stats, msgs = s.messages.map(function(m) {
+    return '<div class="msg"><span style="background:' + m[1] + '">' + esc(m[0]) + '</span></div>'; });
+  el.innerHTML = '<h3>' + esc(sid + ' [ ' + (st.devname || '?') + ' ] ' + (st.layout || '')) + '</h3><pre>'
+    + lines.map(function(line) { return line.join(''); }).join('\\n') + '</pre><div class="stats">'
+    + esc('Keys: ' + st.total + ' = Tested: ' + st.tested + ' = To go: ' + st.togo + ' = Pressed: ' + st.pressed
+    + ' = Missing keycodes: ' + st.missing + ' = Chatter: ' + st.chatter + ' =' + (st.extra || '')) + '</div>' + msgs.join('');
+}
+var es = new EventSource('events');
+es.addEventListener('snapshot', function(e) {
+  S = JSON.parse(e.data).sessions;
+  document.getElementById('sessions').innerHTML = '';
+  for (var sid in S) draw(sid);
+});
+es.addEventListener('delta', function(e) {
+  var d = JSON.parse(e.data), changed = {};
+  d.ops.forEach(function(op) {
+    var s = S[op[1]];
+    if (op[0] == 'session') s = S[op[1]] = { map: op[2].map, cells: op[2].cells, keys: {}, stats: {}, messages: [] };
+    else if (op[0] == 'key') { if (op[3] == 'untested') delete s.keys[op[2]]; else s.keys[op[2]] = op[3]; }
+    else if (op[0] == 'message') { s.messages.push([op[2], op[3]]); s.messages = s.messages.slice(-5); }
+    changed[op[1]] = true;
+  });
+  for (var sid in d.stats) { for (var k in d.stats[sid]) S[sid].stats[k] = d.stats[sid][k]; changed[sid] = true; }
+  for (var sid in changed) draw(sid);
+});
+</script></body></html>
+"""
+
+    def __init__(self, addr=None):
+        """ addr is localhost port or Unix socket path (default PORT) """
+        self.addr = self.PORT if addr is None or addr is True else addr
+        self.unix = isinstance(self.addr, str) and not self.addr.isdigit()
+        # session id -> {'map', 'cells': {'row,col': width}, 'keys': {'row,col': state}, 'stats', 'messages'}
+        self.model = {}
+        # changes since the last fan-out, some changes have been dropped (viewers need snapshot)
+        self.pending, self.lost = [], False
+        # model and pending are shared by sessions and the server thread
+        self.lock = threading.Lock()
+        # stats already sent per session (deltas are computed against them)
+        self.sent = {}
+        # viewer fd -> socket, incomplete request, unsent output, queued batches (event streams only)
+        self.conns, self.reqs, self.outs, self.queues = {}, {}, {}, {}
+        # viewers to be disconnected when output is sent, event streams waiting for snapshot
+        self.closing, self.resync = set(), set()
+        self.seq = 0
+        self.thread = None
+
+    def start(self):
+        """ bind server and start serving thread, returns error or None """
+        err = self.listen()
+        if err: return err
+        self.rfd, self.wfd = os.pipe()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='dashboard')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def listen(self):
+        """ bind localhost port or Unix socket accessible only by the same user, returns error or None """
+        if self.unix:
+            # stale socket of ended dashboard
+            if os.path.exists(self.addr) and stat.S_ISSOCK(os.stat(self.addr).st_mode): os.unlink(self.addr)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            umask = os.umask(0o177)
+            try:
+                self.server.bind(self.addr)
+            except socket.error as e:
+                return "dashboard %s - %s" % (self.addr, e.strerror)
+            finally:
+                os.umask(umask)
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self.server.bind(('127.0.0.1', int(self.addr)))
+            except socket.error as e:
+                return "dashboard port %s - %s" % (self.addr, e.strerror)
+        self.server.listen(16)
+        self.server.setblocking(0)
+
+    def url(self):
+        """ where the dashboard listens (actual port if it has been picked by system for port 0) """
+        if self.unix: return "unix:%s" % self.addr
+        return "http://127.0.0.1:%d/" % self.server.getsockname()[1]
+
+    # --- session side (main loop) - only records the change ---
+
+    def mirror(self, gui, sid):
+        """ wrap drawing methods of session gui to publish its changes as session sid """
+        set_keys, key_action, update_stats = gui.set_keys, gui.key_action, gui.update_stats
+        status, banner = gui.status, gui.banner
+        def mirror_keys(keydicts):
+            set_keys(keydicts)
+            self.session(sid, gui.map, keydicts)
+        def mirror_key(keydict, action):
+            key_action(keydict, action)
+            self.key(sid, keydict, action)
+        def mirror_stats(data):
+            update_stats(data)
+            self.stats(sid, data)
+        def mirror_status(txt, bg='cyan'):
+            status(txt, bg)
+            self.message(sid, txt, bg)
+        def mirror_banner(txt, bg='cyan', above=1, bellow=1):
+            banner(txt, bg, above, bellow)
+            self.message(sid, txt, bg)
+        gui.set_keys, gui.key_action, gui.update_stats = mirror_keys, mirror_key, mirror_stats
+        gui.status, gui.banner = mirror_status, mirror_banner
+
+    def publish(self, op):
+        """ queue change for the next fan-out (dropped if viewers are too slow, they get snapshot instead) """
+        if len(self.pending) < self.PENDING:
+            self.pending.append(op)
+        else:
+            self.lost = True
+
+    def session(self, sid, map, keydicts):
+        """ session (re)started with layout map and keys, all keys untested """
+        entry = { 'map': map, 'cells': dict([ ("%d,%d" % (k['row'], k['col']), len(k['label'])) for k in keydicts ]) }
+        with self.lock:
+            self.model[sid] = dict(entry, keys={}, stats={}, messages=[])
+            self.publish(('session', sid, entry))
+
+    def key(self, sid, keydict, action):
+        pos = "%d,%d" % (keydict['row'], keydict['col'])
+        with self.lock:
+            keys = self.model[sid]['keys']
+            if keys.get(pos, 'untested') == action: return
+            if action == 'untested':
+                del keys[pos]
+            else:
+                keys[pos] = action
+            self.publish(('key', sid, pos, action))
+
+    def stats(self, sid, data):
+        with self.lock:
+            self.model[sid]['stats'] = data
+            self.publish(('stats', sid))
+
+    def message(self, sid, txt, bg):
+        """ status line or banner, repeated message is ignored """
+        msg = [ txt.strip(' ='), bg ]
+        with self.lock:
+            entry = self.model.get(sid)
+            if entry is None or entry['messages'][-1:] == [ msg ]: return
+            entry['messages'] = (entry['messages'] + [ msg ])[-self.MESSAGES:]
+            self.publish(('message', sid) + tuple(msg))
+
+    # --- server thread ---
+
+    def copy(self):
+        """ copy of all sessions (called under lock, encoded outside of it) """
+        return dict([ (sid, dict(entry, keys=dict(entry['keys']))) for sid,entry in self.model.items() ])
+
+    def snapshot(self, sessions=None):
+        """ all sessions as JSON """
+        if sessions is None:
+            with self.lock:
+                sessions = self.copy()
+        return json.dumps({ 'seq': self.seq, 'sessions': sessions }, sort_keys=True)
+
+    def sse(self, event, data):
+        return "id: %d\nevent: %s\ndata: %s\n\n" % (self.seq, event, data)
+
+    def fanout(self):
+        """ encode changes since the last fan-out once, queue them to all event streams (bounded) """
+        with self.lock:
+            ops, self.pending = self.pending, []
+            if self.lost: self.resync.update(self.queues.keys())
+            self.lost = False
+            stats = dict([ (op[1], self.model[op[1]]['stats']) for op in ops if op[0] == 'stats' ])
+            # snapshot of the same moment as changes
+            sessions = self.copy() if self.resync else None
+        # stats are sent as changed fields only (all fields after session restart)
+        for op in ops:
+            if op[0] == 'session': self.sent.pop(op[1], None)
+        deltas = {}
+        for sid,data in stats.items():
+            sent = self.sent.get(sid, {})
+            changed = dict([ (k, v) for k,v in data.items() if sent.get(k) != v ])
+            if changed: deltas[sid] = changed
+            self.sent[sid] = data
+        ops = [ list(op) for op in ops if op[0] != 'stats' ]
+        resync, self.resync = self.resync, set()
+        if ops or deltas:
+            self.seq += 1
+            batch = self.sse('delta', json.dumps({ 'seq': self.seq, 'ops': ops, 'stats': deltas }, sort_keys=True))
+            for fd,queue in self.queues.items():
+                if fd in resync: continue
+                if len(queue) < self.QUEUE:
+                    queue.append(batch)
+                else:
+                    # too slow viewer - drop its backlog, it gets fresh snapshot by the next fan-out
+                    del queue[:]
+                    self.resync.add(fd)
+        if sessions is not None:
+            snapshot = self.sse('snapshot', self.snapshot(sessions))
+            for fd in resync:
+                if fd in self.queues: self.queues[fd][:] = [ snapshot ]
+
+    def accept(self):
+        try:
+            conn,_ = self.server.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        fd = conn.fileno()
+        self.conns[fd], self.reqs[fd], self.outs[fd] = conn, '', ''
+
+    def receive(self, fd):
+        """ HTTP request (GET only), data from event stream viewer is ignored, EOF = viewer gone """
+        try:
+            data = self.conns[fd].recv(4096)
+        except socket.error:
+            data = ''
+        if not data: return self.close(fd)
+        if fd not in self.reqs: return
+        self.reqs[fd] += data
+        if '\r\n\r\n' not in self.reqs[fd] and '\n\n' not in self.reqs[fd]:
+            if len(self.reqs[fd]) > 8192: self.close(fd)
+            return
+        path = (self.reqs.pop(fd).split(None, 2)[1:2] or [''])[0].split('?')[0]
+        if path == '/events':
+            self.outs[fd] = "HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\nretry: 1000\n\n"
+            self.queues[fd] = []
+            self.resync.add(fd)
+        elif path == '/snapshot':
+            self.respond(fd, '200 OK', 'application/json', self.snapshot() + '\n')
+        elif path == '/':
+            self.respond(fd, '200 OK', 'text/html; charset=utf-8', self.PAGE)
+        else:
+            self.respond(fd, '404 Not Found', 'text/plain', 'not found\n')
+
+    def respond(self, fd, status, ctype, body):
+        """ single response, viewer is disconnected when it is sent """
+        self.outs[fd] = "HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" \
+                        % (status, ctype, len(body), body)
+        self.closing.add(fd)
+
+    def send(self, fd):
+        """ write as much of output (and queued batches) as socket accepts """
+        if not self.outs[fd] and self.queues.get(fd):
+            self.outs[fd] = ''.join(self.queues[fd])
+            del self.queues[fd][:]
+        try:
+            sent = self.conns[fd].send(self.outs[fd])
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR): return
+            return self.close(fd)
+        self.outs[fd] = self.outs[fd][sent:]
+        if not self.outs[fd] and fd in self.closing: self.close(fd)
+
+    def close(self, fd):
+        conn = self.conns.pop(fd)
+        for viewers in (self.reqs, self.outs, self.queues):
+            viewers.pop(fd, None)
+        self.closing.discard(fd)
+        self.resync.discard(fd)
+        conn.close()
+
+    def run(self):
+        """ select loop over server, viewers and stop pipe, fan-out every PERIOD """
+        server = self.server.fileno()
+        nextfan = monotonic()
+        while self.running:
+            writers = [ fd for fd in self.conns if self.outs[fd] or self.queues.get(fd) ]
+            try:
+                ready,writable,_ = select.select([ server, self.rfd ] + self.conns.keys(), writers, [],
+                                                 max(0.0, nextfan - monotonic()))
+            except select.error as e:
+                if e.args[0] != errno.EINTR: raise
+                continue
+            if server in ready: self.accept()
+            for fd in ready:
+                if fd in self.conns: self.receive(fd)
+            if monotonic() >= nextfan:
+                self.fanout()
+                nextfan = monotonic() + self.PERIOD
+            for fd in writable:
+                if fd in self.conns: self.send(fd)
+        # the last changes (final verdicts) to viewers which can take them now
+        self.fanout()
+        for fd in self.conns.keys():
+            if fd in self.conns and (self.outs[fd] or self.queues.get(fd)): self.send(fd)
+            if fd in self.conns: self.close(fd)
+
+    def stop(self):
+        """ stop serving thread (final changes are sent), close server socket """
+        if self.thread is None: return
+        self.running = False
+        os.write(self.wfd, 'x')
+        self.thread.join(1.0)
+        self.thread = None
+        self.server.close()
+        os.close(self.rfd)
+        os.close(self.wfd)
+        if self.unix and os.path.exists(self.addr): os.unlink(self.addr)
 
 
 class Test:
     """ test the keyboard key by key """
 
-    def __init__(self):
-        """ init required classes """
-        # keycode -> (row,col), key, tested
+    # rescan period [s] and duration after hot-plug notification (X server registers device a bit later)
+    SCAN, SETTLE = 0.1, 2.0
+
+    def __init__(self, xinput=None, top=1, opts=None, registry=None):
+        """ init required classes, opts are command line options, registry can be shared by more tests """
+        self.opts = opts or {}
+        # keycode -> (row,col), key, label, tested
         self.layout = Layout()
-        self.xinput = Xinput()
-        self.gui = Gui(self.xinput.version())
+        # input backend Xinput (default) or Evdev
+        self.xinput = xinput or Xinput()
+        # cached backend version and device list
+        self.registry = registry or Registry(self.xinput)
+        # --headless[=fd] streams JSON lines instead of drawing
+        self.headless = self.opts.get('headless')
+        if self.headless:
+            self.gui = Headless(self.registry.version(), 1 if self.headless is True else int(self.headless))
+        else:
+            self.gui = Gui(self.registry.version(), top)
+        # key timing analysis --chatter=ms[,bounces]
+        self.timing = KeyTiming(*[ float(v) for v in self.opts.get('chatter', '').split(',') if v ],
+                                readtime=self.xinput.exe == 'xinput')
+        # rollover and ghosting test (--rollover), created when layout is loaded
+        self.rollover = None
+        # polling rate and jitter --rate=hz
+        self.pollrate = PollRate(int(self.opts['rate'])) if self.opts.get('rate') else None
+        # end test after idle timeout [s] without key events --idle=s
+        self.idle = float(self.opts['idle']) if self.opts.get('idle') else None
+        self.idled = False
+        # session result has been shown and stored (station)
+        self.ended = False
+        # stage profiling --profile[=file]
+        self.profile = None
+        # layout identification by pressed keycodes, created when layout is loaded
+        self.rank = None
+        # the last pressed keycode not found in layout and its footer text (keysyms lookup may scan rev_xmodmap)
+        self.unknown, self.unknownline = None, ''
+        # end-to-end latency --latency, (key position, action, timestamp) of events not on screen yet
+        self.latency = Latency() if self.opts.get('latency') else None
+        self.unflushed = []
+        # time from process start (or session request) to the first frame drawn [s]
+        self.launched, self.startup = STARTED, None
+        # live dashboard --dashboard[=port|sock]
+        self.dashboard = None
+        # the last key events for post-mortem dump --history[=n]
+        self.history = None
+        if self.opts.get('history'):
+            self.history = History() if self.opts['history'] is True else History(int(self.opts['history']))
 
     def find_1st(self, path='.', mask='.lay'):
-        """ find the 1st file matching mask in directory path """
-        for f in os.listdir(path):
+        """ find the 1st file matching mask in directory path (alphabetically) """
+        for f in sorted(os.listdir(path)):
             if f.endswith(mask):
                 return f
 
@@ -630,12 +2753,10 @@ class Test:
     def load_gmap(self, gmapfname):
         """ load specified graphic map file """
         self.gui.banner(" = Loading keyboard layout file: %s = " % gmapfname)
-        # load graphical layout from file
-        gmap = self.layout.load_gmap(gmapfname)
+        # load graphical layout from file and parse (or get both from compiled layout cache)
+        gmap, err = self.layout.compile(gmapfname)
         # set to gui
         self.gui.set_map(gmap)
-        # parse
-        err = self.layout.parse_gmap(gmap)
         # store only count of missing keys
         self.key_missing = len(err)
         # show errors if any and wait for user confirmation
@@ -646,15 +2767,20 @@ class Test:
         if len(err) == 0: return
         for e in err:
             self.gui.banner(" ERR: %s " % e, bg='red', above=0, bellow=0)
+        # no prompts in headless mode
+        if self.headless: return
         print
         print "This is caused either by:"
         print "\t - problems in layout file: %s (incorrect [ key_labels ] etc )" % self.gmapfname
-        print "\t - missing dictionary entries in rev_xmodmap = {...} ( Layout class )"
+        print "\t - key labels not found in keymap (%s) nor in rev_xmodmap = {...} ( Layout class )" \
+              % (self.layout.keymap.source if self.layout.keymap else 'built-in')
         print
         _ = raw_input('Press ENTER to continue ...')
 
     def kut_id(self, id=None):
         """ returns either specific keyboard unde test id or guide user with autodetection """
+        # device path (evdev)
+        if isinstance(id, str): return id
         try:
             int(id)
         except TypeError as e:
@@ -665,13 +2791,16 @@ class Test:
         """ checking changes in xinput list when connecting unknown kbd reveals its id """
         self.gui.banner(" = Autodetection process started ... = ")
         print "Connect or Reconnect keyboard you want to test ",
-        ref = self.xinput.list()
+        hotplug = HotPlug()
+        ref = self.registry.list()
         while True:
-            act = self.xinput.list()
+            # wait for hot-plug notification (dot every second)
+            if not hotplug.wait(1.0):
+                self.gui.write_flush('.')
+                continue
+            act = self.settle(ref)
             # no change - loop again
             if len(act) == len(ref):
-                self.gui.write_flush('.')
-                time.sleep(1)
                 continue
             # something disconnected - take new reference nad loop again
             if len(act) < len(ref):
@@ -686,13 +2815,72 @@ class Test:
                 print
                 print "Device connected   :", ' / '.join(added)
                 break
-        # extract minimal id = first of sorted list
+        hotplug.close()
+        # extract ids, if there are more (xinput double entries) take the one which emits key events
         # Mitsumi Electric Apple Extended USB Keyboard      id=8    [slave  keyboard (3)]
-        id = sorted([int(part.replace('id=', '')) for item in added for part in item.split() if part.startswith('id=')])[0]
-        self.gui.banner(" = Autodetection done = detected xinput id:%d [ %s ] = " % (id, self.xinput.name_by_id(id)))
+        ids = sorted([int(part.replace('id=', '')) for item in added for part in item.split() if part.startswith('id=')])
+        id = ids[0] if len(ids) == 1 else self.probe_ids(ids)
+        self.gui.banner(" = Autodetection done = detected xinput id:%d [ %s ] = " % (id, self.registry.name_by_id(id)))
         time.sleep(1)
         return id
 
+    def settle(self, ref, timeout=2.0, period=0.05):
+        """ device list after hot-plug notification - X server registers the device a bit later """
+        end = time.time() + timeout
+        self.registry.refresh()
+        act = self.registry.list()
+        while act == ref and time.time() < end:
+            time.sleep(period)
+            self.registry.refresh()
+            act = self.registry.list()
+        return act
+
+    def probe_ids(self, ids):
+        """ listen on all candidate ids and take the one which emits key events first """
+        print "Multiple ids found: %s - press any key on the keyboard you want to test" % ' / '.join(map(str, ids))
+        probes = {}
+        # probes of the same backend (not of recording wrapper)
+        backend_class = getattr(self.xinput, 'backend', self.xinput).__class__
+        for id in ids:
+            backend = backend_class()
+            if not backend.start(id): probes[backend.fileno()] = (id, backend)
+        found = None
+        while found is None and probes:
+            for fd in select.select(probes.keys(), [], [], 1.0)[0]:
+                id, backend = probes[fd]
+                if backend.events():
+                    found = id
+                    break
+                # input ended
+                if not backend.is_running(): del probes[fd]
+        for id, backend in probes.values():
+            backend.stop()
+        return ids[0] if found is None else found
+
+    def session_setup(self, gmapfname, gmap, id):
+        """ prepare non-interactive session (station, benchmark) with already loaded and checked layout """
+        self.gmapfname, self.id = gmapfname, id
+        self.devname = self.registry.name_by_id(id)
+        self.started = time.time()
+        # own layout state per session
+        self.gui.set_map(gmap)
+        self.key_missing = len(self.layout.compile(gmapfname)[1])
+        self.ignore_1st()
+        self.quit(phrase='quit')
+
+    def session_start(self, id, running=False):
+        """ start input (unless already running) and draw non-interactive session (station, daemon), returns error or None """
+        err = None if running else self.xinput.start(id)
+        self.gui.show_map()
+        self.gui.set_keys(self.layout.layout.values())
+        self.rollover_setup()
+        if err:
+            self.gui.status(" = ERR: %s = " % err, bg='red')
+        else:
+            self.update_stats()
+            self.render()
+        return err
+
     def pars_setup(self, gmapfname, id):
         """ load gmap layout, open xinput dev.id """
         # gmap file either specific or first in dir
@@ -700,10 +2888,12 @@ class Test:
         # device id either specific or auto detected by user actions
         self.id = self.kut_id(id)
         # dev name
-        self.devname = self.xinput.name_by_id(self.id)
+        self.devname = self.registry.name_by_id(self.id)
 
     def test_setup(self):
         """ process prerequisites - load layout file, start xinput process """
+        self.started = time.time()
+        if self.opts.get('profile'): self.profile_setup(Profile())
         # load gmap file and show errors if any
         self.load_gmap(self.gmapfname)
         # terminal
@@ -712,10 +2902,100 @@ class Test:
         err = self.xinput.start(self.id)
         # draw gui layout map and stats
         self.gui.show_map()
+        self.gui.set_keys(self.layout.layout.values())
+        self.rollover_setup()
+        self.rank_setup()
         self.update_stats()
+        self.render()
+
+    def rank_setup(self):
+        """ index layouts in kbd-tst dir, its layouts subdir and actual dir for layout identification """
+        home = os.path.dirname(os.path.abspath(__file__))
+        self.rank = LayoutRank(LayoutIndex([ home, os.path.join(home, 'layouts'), '.' ]), self.layout)
+
+    def rank_event(self, keycode):
+        """ rank layouts by pressed keycode, suggest or switch to better matching layout, returns True if switched """
+        if not self.rank.event(keycode): return False
+        best = self.rank.suggestion()
+        if not (best and self.opts.get('autolayout')): return False
+        self.switch_layout(best[0])
+        return True
+
+    def switch_layout(self, gmapfname):
+        """ load another layout keeping all tested keys (by keycode) """
+        tested = [ kc for kc in range(Layout.KEYCODES) if self.layout.tested[kc] and not self.layout.pressed[kc] ]
+        self.gmapfname, self.layout = gmapfname, Layout()
+        gmap, err = self.layout.compile(gmapfname)
+        self.key_missing = len(err)
+        self.gui.set_map(gmap)
+        self.gui.show_map()
+        self.gui.set_keys(self.layout.layout.values())
+        for kc in tested:
+            keydict = self.layout.keycode_to_key(kc)
+            if not keydict: continue
+            self.layout.key_action(kc, 'release')
+            self.gui.key_action(keydict, 'release')
+        self.rank.set_layout(self.layout)
+        if self.profile: self.profile.wrap(self.layout, 'keycode_to_key', 'lookup')
+        self.rollover_setup()
+
+    def profile_setup(self, profile):
+        """ time stages of event pipeline: read, parse, process, lookup, draw, render, stats """
+        self.profile = profile
+        backend = getattr(self.xinput, 'backend', self.xinput)
+        profile.wrap(self.xinput, 'events', 'read')
+        if hasattr(backend, 'parse'): profile.wrap(backend, 'parse', 'parse')
+        profile.wrap(self, 'process', 'process')
+        profile.wrap(self.layout, 'keycode_to_key', 'lookup')
+        profile.wrap(self.gui, 'key_action', 'draw')
+        profile.wrap(self.gui, 'render', 'render')
+        profile.wrap(self, 'update_stats', 'stats')
+
+    def dashboard_setup(self, dashboard):
+        """ mirror key states, footer stats and messages of this session to live dashboard (before the map is drawn) """
+        self.dashboard = dashboard
+        dashboard.mirror(self.gui, str(self.id))
+
+    def history_dump(self):
+        """ dump event history into session log named by device and time, returns (text, color) for status / report """
+        fname = "kbd-tst-%s-%s.log" % (re.sub(r'\W+', '_', str(self.id)).strip('_'),
+                                       datetime.datetime.now().strftime('%Y%m%d-%H%M%S.%f')[:-3])
+        err = self.history.dump(fname)
+        if err: return " = HISTORY = ERR: %s = " % err, 'red'
+        return " = HISTORY = last %d events dumped to %s (see --replay) = " % (self.history.count, fname), 'cyan'
+
+    def rollover_setup(self):
+        """ start rollover test and prompt the 1st chord pattern if requested """
+        if not self.opts.get('rollover'): return
+        self.rollover = Rollover(self.layout)
+        self.rollover_prompt('prompt')
+
+    def rollover_prompt(self, state):
+        """ draw keys of actual rollover pattern as prompt or back as tested / untested / ghost """
+        if self.rollover.done(): return
+        for keycode in self.rollover.pattern()[2]:
+            keydict = self.layout.keycode_to_key(keycode)
+            if state != 'prompt':
+                state = 'release' if self.layout.tested[keycode] else 'untested'
+            self.gui.key_action(keydict, state)
+
+    def rollover_event(self, keycode, action):
+        """ track held chord, on pattern finish mark ghosts and prompt the next pattern """
+        pattern = None if self.rollover.done() else self.rollover.pattern()
+        if not self.rollover.event(keycode, action):
+            # released key of still prompted chord
+            if action == 'release' and pattern and keycode in pattern[2]:
+                self.gui.key_action(self.layout.keycode_to_key(keycode), 'prompt')
+            return
+        for kc in pattern[2]:
+            self.gui.key_action(self.layout.keycode_to_key(kc), 'release' if self.layout.tested[kc] else 'untested')
+        for kc,keydict in self.layout.layout.items():
+            if self.rollover.is_ghost(kc): self.gui.key_action(keydict, 'ghost')
+        self.rollover_prompt('prompt')
 
     def terminal_setup(self):
         """ setup terminal """
+        if self.headless: return
         # termios - no echo
         self.stdinfd = sys.stdin.fileno()
         self.saveattr = termios.tcgetattr(self.stdinfd)
@@ -731,27 +3011,169 @@ class Test:
         self.ignore_1st(ignorekey='RET')
         # setup quit phrase
         self.quit(phrase='quit')
+        self.loop_setup()
         # loop until all is tested
-        while not self.all_tested() and self.xinput.is_running():
-            # key event from xinput
-            action,keycode = self.keypress()
-            # get keydict struct from layout with coordinates, label, etc
-            keydict = self.layout.keycode_to_key(keycode)
-            # ignore unknown keys
-            if not keydict: continue
-            # ignore 1st keycode
-            if self.ignore_1st(keycode=keycode): continue
-            # gui visual feedback
-            self.gui.key_action(keydict, action)
-            # register key as tested
-            self.key_tested(action, keydict)
-            # footer stats
-            self.update_stats()
-            # detect quit phrase
-            if self.quit(key=keydict['key']): break
+        done = False
+        try:
+            while not done and not self.all_tested():
+                done = self.loop_once()
+        except KeyboardInterrupt:
+            pass
+        self.loop_teardown()
         #
+        self.render(force=True)
         self.test_teardown()
 
+    def render(self, force=False):
+        """ draw screen changes, events shown by the frame count into end-to-end latency """
+        if not self.gui.render(force): return
+        if self.startup is None: self.startup = monotonic() - self.launched
+        if not self.latency: return
+        # releases deferred by minimal visible time are not on screen yet
+        pending = getattr(self.gui, 'pending', {})
+        shown, deferred = [], []
+        for pos,action,tstamp in self.unflushed:
+            if action == 'release' and pos in pending: deferred.append((pos, action, tstamp))
+            else: shown.append(tstamp)
+        self.latency.flushed(shown, monotonic())
+        self.unflushed = deferred
+
+    def loop_setup(self):
+        """ signals (terminate, resize) via wakeup pipe, hot-plug monitor for unplug / reconnect of physical device """
+        self.signals = Signals([signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1] + ([] if self.headless else [signal.SIGWINCH]))
+        self.monitor = HotPlug() if self.reconnectable() and self.xinput.is_running() else None
+        self.settling, self.lastscan = 0, 0
+        self.lastevent = time.time()
+        self.disconnected = False
+
+    def loop_teardown(self):
+        self.signals.close()
+        if self.monitor: self.monitor.close()
+
+    def loop_once(self):
+        """ single select over input, stdin, hot-plug monitor, signals and timers, returns True if test has ended """
+        now = time.time()
+        running = self.xinput.is_running()
+        sig, hp = self.signals.fileno(), self.monitor and self.monitor.fileno()
+        # input without descriptor (replayed log) waits for its next events itself
+        pull = running and self.xinput.fileno() is None
+        fds = [ sig ] + ([ self.xinput.fileno() ] if running and not pull else []) + ([] if hp is None else [ hp ])
+        # ENTER on any keyboard ends the test while the keyboard under test is disconnected
+        if self.disconnected and not self.headless: fds.append(self.stdinfd)
+        # wake up for pending frame, hot-plug polling/rescan and idle timeout
+        waits = [ self.gui.frame_wait(), self.monitor and self.monitor.timeout() ]
+        if now < self.settling: waits.append(self.SCAN)
+        if self.idle: waits.append(max(0.0, self.lastevent + self.idle - now))
+        waits = [ w for w in waits if w is not None ]
+        wait = min(waits) if waits else None
+        try:
+            ready = select.select(fds, [], [], 0 if pull else wait)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR: raise
+            ready = [ sig ]
+        if sig in ready:
+            received = self.signals.received()
+            if received & set([signal.SIGTERM, signal.SIGHUP]): return True
+            if signal.SIGWINCH in received: self.gui.redraw()
+            if signal.SIGUSR1 in received and self.history: self.gui.status(*self.history_dump())
+        if pull or running and self.xinput.fileno() in ready:
+            # burst of key events processed in one pass
+            for action,keycode,tstamp in self.keypress(wait if pull else None):
+                self.lastevent = time.time()
+                # detect quit phrase
+                if self.process(action, keycode, tstamp) or self.all_tested(): return True
+        if self.monitor and (hp is None or hp in ready) and self.monitor.changed():
+            self.settling = time.time() + self.SETTLE
+        if time.time() < self.settling and time.time() - self.lastscan >= self.SCAN: self.rescan()
+        if not self.xinput.is_running() and not self.disconnected:
+            # pipe / replayed log ended or input could not be started
+            if not self.monitor: return True
+            self.disconnect()
+        if self.disconnected and not self.headless and self.stdinfd in ready:
+            os.read(self.stdinfd, 1024)
+            return True
+        if self.idle and time.time() - self.lastevent >= self.idle:
+            self.idled = True
+            return True
+        # draw changes of the whole burst at once (paced by frame rate), disconnect status stays
+        if not self.disconnected: self.render()
+        return False
+
+    def reconnectable(self):
+        """ physical device which can be unplugged and connected again (not a pipe or replayed log) """
+        if self.xinput.exe == 'xinput': return True
+        return self.xinput.exe == 'evdev' and (not isinstance(self.id, str) or self.id.startswith('/dev/'))
+
+    def locate(self):
+        """ id of keyboard under test if connected - the same id or the first device with the same name, None otherwise """
+        if isinstance(self.id, str): return self.id if os.path.exists(self.id) else None
+        self.registry.refresh()
+        names = self.registry.names()
+        if names.get(self.id) == self.devname: return self.id
+        same = [ id for id,name in sorted(names.items()) if name == self.devname ]
+        return same[0] if same else None
+
+    def rescan(self):
+        """ after hot-plug stop input of removed keyboard or restart input of reconnected one (key state is kept) """
+        self.lastscan = time.time()
+        id = self.locate()
+        if self.xinput.is_running():
+            # xinput test keeps running silently when its device is removed
+            if id is None: self.xinput.stop()
+            return
+        if id is None or self.xinput.start(id): return
+        self.id, self.disconnected = id, False
+        self.lastevent = time.time()
+
+    def disconnect(self):
+        """ keyboard under test removed - keep key state and wait for reconnect """
+        self.disconnected = True
+        self.settling = time.time() + self.SETTLE
+        self.gui.status(" = Keyboard disconnected = Reconnect it to continue the test or press ENTER to end = ", bg='yellow')
+
+    def process(self, action, keycode, tstamp=0.0):
+        """ process single key event, returns True if quit phrase has been detected """
+        # post-mortem event history
+        if self.history: self.history.append(action, keycode, tstamp)
+        # get keydict struct from layout with coordinates, label, etc
+        keydict = self.layout.keycode_to_key(keycode)
+        # ignore 1st keycode (evaluated for keys in layout only)
+        ignored = keydict is not None and self.ignore_1st(keycode=keycode)
+        # layout identification (may switch layout), ignored key and keycodes out of X range are not indexed
+        if self.rank and action == 'press' and not ignored and keycode < Layout.KEYCODES and self.rank_event(keycode):
+            keydict = self.layout.keycode_to_key(keycode)
+        # event record
+        if self.headless: self.gui.event(action, keycode, tstamp, keydict)
+        # ignore unknown keys (shown in footer)
+        if not keydict:
+            if action == 'press' and keycode != self.unknown:
+                self.unknown = keycode
+                self.unknownline = " Not in layout: %s (%d) =" \
+                                   % (' / '.join(self.layout.keycode_to_keysyms(keycode)[:2]) or '?', keycode)
+                self.update_stats()
+            return False
+        if ignored: return False
+        # key timing statistics
+        self.timing.event(keycode, action, tstamp)
+        if self.latency: self.unflushed.append(((keydict['row'], keydict['col']), action, tstamp))
+        # report timestamps for polling rate (autorepeat is generated by kernel, not by keyboard)
+        if self.pollrate and not (action == 'press' and self.layout.pressed[keycode]): self.pollrate.event(tstamp)
+        # gui visual feedback
+        self.gui.key_action(keydict, action)
+        # register key as tested
+        self.key_tested(action, keydict)
+        # held chord for rollover test
+        if self.rollover: self.rollover_event(keycode, action)
+        # footer stats
+        self.update_stats()
+        # detect quit phrase
+        if self.quit(key=keydict['key']): return True
+        # detect dump phrase (typed once = dumped once)
+        if self.history and ''.join(self.lastkeys) == 'dump':
+            self.lastkeys = [chr(31)] * len(self.lastkeys)
+            self.gui.status(*self.history_dump())
+        return False
+
     def ignore_1st(self, ignorekey=None, keycode=None):
         """ setup and evaluate ignoring the first key (usually ENTER) """
         # has keycode = evaluate mode
@@ -778,7 +3200,7 @@ class Test:
         if key == self.lastkeys[len(self.lastkeys)-1]: return False
         self.lastkeys.append(key)
         self.lastkeys.pop(0)
-        self.gui.write_at(20,0)
+        self.gui.park()
         return ''.join(self.lastkeys) == self.phrase
 
     def test_teardown(self):
@@ -789,6 +3211,7 @@ class Test:
 
     def terminal_reset(self):
         """ reset terminal back to normal """
+        if self.headless: return
         # saved attributes back
         termios.tcsetattr(self.stdinfd, termios.TCSADRAIN, self.saveattr)
         # activate cursor back on
@@ -797,17 +3220,21 @@ class Test:
         termios.tcflush(self.stdinfd, termios.TCIFLUSH)
 
     def key_tested(self, action, keydict):
-        """ mark key as tested """
-        if action == 'release': keydict['tested'] = True
+        """ mark key as tested (on release) """
+        self.layout.key_action(keydict['keycode'], action)
 
     def update_stats(self):
         """ update footer stats """
-        tested = len([ k for k,v in self.layout.layout.items() if v['tested'] ])
+        tested = self.layout.ntested
         total  = len(self.layout.layout) + self.key_missing
         stats = {
             'total': total,
             'tested': tested,
             'togo': total - tested - self.key_missing,
+            'pressed': self.layout.npressed,
+            'chatter': self.timing.nflagged,
+            'extra': (self.rollover.status() if self.rollover else '') + (self.pollrate.status() if self.pollrate else '') \
+                     + (self.latency.status() if self.latency else '') + self.rank_status() + self.unknown_status(),
             'missing': self.key_missing,
             'id': self.id,
             'devname': self.devname,
@@ -815,66 +3242,950 @@ class Test:
         }
         self.gui.update_stats(stats)
 
+    def rank_status(self):
+        """ short layout suggestion for footer """
+        best = self.rank and self.rank.suggestion()
+        if not best: return ''
+        return " Layout? %s (%d/%d keys) =" % (os.path.basename(best[0]), best[1], self.rank.observed)
+
+    def unknown_status(self):
+        """ names of the last pressed key not in layout for footer (built once when the key is pressed) """
+        return self.unknownline
+
     def all_tested(self):
-        """ are we doone = all keys has been tested """
-        return all([ v['tested'] for k,v in self.layout.layout.items() ])
-
-    def keypress(self):
-        """ xinput key event press/release and keycode"""
-        # wait for key
-        line = self.xinput.readline()
-        # key press 128
-        m = re.search('key (press|release)\s+(\d+)', line)
-        # this should not happen: return if not key press|release
-        if not m: return '',0
-        action  = m.group(1)
-        keycode = m.group(2)
-        # return action (press/release0 and int keycode
-        return action,int(keycode)
+        """ are we doone = all keys has been tested (and all rollover patterns) """
+        return self.layout.all_tested() and (not self.rollover or self.rollover.done())
 
-    def report(self):
-        """ mini report - right now only timestamp """
+    def keypress(self, timeout=None):
+        """ batch of key events (action, keycode, timestamp) from input backend """
+        return self.xinput.events(timeout)
+
+    def verdict(self):
+        """ test result as (report text, color) """
         now = datetime.datetime.now()
-        tested = len([k for k, v in self.layout.layout.items() if v['tested']])
+        tested = self.layout.ntested
         total = len(self.layout.layout) + self.key_missing
         untested = total - tested
         if self.all_tested():
             if untested == 0:
-                self.gui.banner(" = TEST PASSED = All %d keys has been successfully tested @ %s = " % (tested, now), \
-                                bg='green', above=2, bellow=1)
-            else:
-                self.gui.banner(" = TEST WARNING = Only %d of %d [ %.1f%% ] keys has been successfully tested @ %s = " \
-                                % (tested, total, 100.0*tested/total, now), bg='yellow', above=2, bellow=1)
+                return " = TEST PASSED = All %d keys has been successfully tested @ %s = " % (tested, now), 'green'
+            return " = TEST WARNING = Only %d of %d [ %.1f%% ] keys has been successfully tested @ %s = " \
+                   % (tested, total, 100.0*tested/total, now), 'yellow'
+        return " = TEST FAILED = Only %d of %d [ %.1f%% ] keys has been successfully tested @ %s = " \
+               % (tested, total, 100.0*tested/total, now), 'red'
+
+    def results(self):
+        """ verdict and results of optional tests as list of (report text, color) """
+        lines = [ self.verdict() ]
+        # input lines / events which could not be decoded
+        if self.xinput.bad:
+            lines.append((" = %s: %d unparsable input lines/events ignored = " % (self.xinput.exe, self.xinput.bad), 'yellow'))
+        # rollover and ghosting
+        if self.rollover:
+            bg = 'red' if self.rollover.nghosts or self.rollover.failed() or not self.rollover.done() else 'green'
+            lines.append((" = %s = " % self.rollover.summary(), bg))
+        # polling rate and jitter
+        if self.pollrate:
+            passed, txt = self.pollrate.result()
+            if self.xinput.exe == 'xinput': txt += " = %s timestamps are not kernel timestamps, use --evdev" % self.xinput.exe
+            lines.append((" = %s = " % txt, 'green' if passed else 'red'))
+        # chattering keys
+        for keycode,keydict in sorted(self.layout.layout.items()):
+            if not self.timing.flagged[keycode]: continue
+            txt = self.timing.summary(keycode)
+            if self.timing.readtime: txt += " = gaps are %s read times (no X server timestamps), use --evdev" % self.xinput.exe
+            lines.append((" = CHATTER key [ %s ] = %s = " % (keydict['key'], txt), 'red'))
+        # better matching layout
+        best = self.rank and self.rank.suggestion()
+        if best:
+            lines.append((" = LAYOUT SUGGESTION = %s matches %d of %d pressed keys, %s only %d = " \
+                          % (best[0], best[1], self.rank.observed, self.gmapfname, self.rank.current), 'yellow'))
+        # end-to-end latency
+        if self.latency:
+            txt = self.latency.summary()
+            if self.xinput.exe == 'xinput': txt += " = measured from xinput read time (no X server timestamps)"
+            lines.append((" = %s = " % txt, 'cyan'))
+        # idle timeout
+        if self.idled:
+            lines.append((" = IDLE TIMEOUT = no key events for %g s = " % self.idle, 'yellow'))
+        # frame pacing stats
+        if self.opts.get('frames'):
+            lines.append((" = %s = " % self.gui.frame_stats(), 'cyan'))
+            if self.startup is not None:
+                lines.append((" = STARTUP = first frame drawn %.1f ms after process start = " % (1000 * self.startup), 'cyan'))
+        # stage profile
+        if self.profile:
+            lines.extend([ (" = %s = " % line, 'cyan') for line in self.profile.breakdown() ])
+        return lines
+
+    def summary(self, lines):
+        """ machine readable summary of results """
+        colors = [ bg for txt,bg in lines ]
+        return {
+            'result': 'failed' if 'red' in colors else 'warning' if 'yellow' in colors else 'passed',
+            'id': self.id,
+            'device': self.devname,
+            'layout': self.gmapfname,
+            'total': len(self.layout.layout) + self.key_missing,
+            'tested': self.layout.ntested,
+            'missing': self.key_missing,
+            'untested': [ keydict['key'] for keycode,keydict in sorted(self.layout.layout.items())
+                          if not self.layout.tested[keycode] ],
+            'chatter': [ keydict['key'] for keycode,keydict in sorted(self.layout.layout.items())
+                         if self.timing.flagged[keycode] ],
+            'startup_ms': self.startup and round(1000 * self.startup, 1),
+            'results': [ txt.strip(' =') for txt,bg in lines ]
+        }
+
+    def report(self):
+        """ mini report - verdict and results of optional tests, returns True if nothing has failed """
+        lines = self.results()
+        # post-mortem event history of failed test
+        if self.history and lines[0][1] == 'red': lines.append(self.history_dump())
+        for i,(txt,bg) in enumerate(lines):
+            self.gui.banner(txt, bg=bg, above=0 if i else 2, bellow=1)
+        if self.headless: self.gui.summary(self.summary(lines))
+        return 'red' not in [ bg for txt,bg in lines ]
+
+
+class Station:
+    """ test multiple keyboards at once - one Test session per hot-plugged device multiplexed by select """
+
+    header = '= %(about)s = version %(version)s = Station mode = Connect keyboards to test = Sessions: %(sessions)s = CTRL-C to end ='
+
+    # rescan period [s] and duration after hot-plug notification (X server registers device a bit later)
+    SCAN, SETTLE = 0.1, 2.0
+
+    def __init__(self, backend=Xinput, opts=None, dashboard=None):
+        """ backend is input class Xinput or Evdev, opts are command line options, dashboard is started Dashboard """
+        self.backend = backend
+        self.opts = opts or {}
+        self.dashboard = dashboard
+        # device list and version shared by all sessions
+        self.registry = Registry(backend())
+        self.registry.prefetch()
+        # device id -> Test session
+        self.sessions = {}
+        # results database --db=path
+        self.db = ResultsDB(self.opts['db']) if self.opts.get('db') else None
+        # stage profile of all sessions --profile[=file]
+        self.profile = Profile() if self.opts.get('profile') else None
+        # screen tiles: slot -> device id (None = free)
+        self.slots = []
+        # idle inputs of connected devices waiting for the first key event: fd -> (device id, backend)
+        self.probes = {}
+        # ids of sessions with tile bellow the terminal (tested without drawing) and their shared output
+        self.offscreen, self.devnull = set(), None
+        # event history dumps of failed sessions (device name, id, text) listed at the end
+        self.dumps = []
+
+    def setup(self, gmapfname, ids=None):
+        """ load layout once (errors are shown only once), reference device list and optional specific ids """
+        proto = Test(self.backend(), registry=self.registry)
+        proto.gmapfname = proto.gmap_filename(gmapfname)
+        proto.load_gmap(proto.gmapfname)
+        self.gmapfname, self.gmap = proto.gmapfname, proto.gui.map
+        # tile = header + separator + map + separator + footer
+        self.tile = len(self.gmap) + 4
+        # devices connected before station start are not tested
+        self.ref = self.scan()
+        self.lastscan, self.settling = time.time(), 0
+        self.monitor = HotPlug()
+        for id in (ids or []):
+            self.start_session(id)
+
+    def scan(self):
+        """ set of connected keyboard device ids """
+        self.registry.refresh()
+        return set(self.registry.names().keys())
+
+    def slot(self, id):
+        """ allocate the first free screen tile for device id """
+        for i,dev in enumerate(self.slots):
+            if dev is None:
+                self.slots[i] = id
+                return i
+        self.slots.append(id)
+        return len(self.slots) - 1
+
+    def probe(self, id):
+        """ listen on device id without tile, session starts by the first key event (keyboards have more ids) """
+        backend = self.backend()
+        if not backend.start(id): self.probes[backend.fileno()] = (id, backend)
+
+    def probe_events(self, fd):
+        """ start session on probe which emits key events, drop probe of ended input """
+        id, backend = self.probes[fd]
+        events = backend.events()
+        if events or not backend.is_running(): del self.probes[fd]
+        if events: self.start_session(id, backend, events)
+        elif not backend.is_running(): backend.stop()
+
+    def start_session(self, id, backend=None, events=()):
+        """ start new test session for device id in its own tile, running probe backend and its events are taken over """
+        top = 2 + self.slot(id) * self.tile
+        tst = Test(backend or self.backend(), top=top, opts=self.opts, registry=self.registry)
+        # tile does not fit into terminal - test without drawing, result goes to db, dashboard and final summary
+        rows = Gui('').term_size()[0]
+        if rows and top + self.tile - 1 > rows:
+            self.devnull = self.devnull or open(os.devnull, 'w')
+            tst.gui.out = self.devnull
+            self.offscreen.add(id)
+        tst.session_setup(self.gmapfname, self.gmap, id)
+        if self.profile: tst.profile_setup(self.profile)
+        if self.dashboard: tst.dashboard_setup(self.dashboard)
+        tst.session_start(id, running=backend is not None)
+        self.sessions[id] = tst
+        self.show_header()
+        for action,keycode,tstamp in events:
+            if tst.process(action, keycode, tstamp) or tst.all_tested():
+                self.end_session(id)
+                break
+
+    def end_session(self, id):
+        """ stop input and show the result in the tile footer (once per session) """
+        tst = self.sessions[id]
+        if tst.ended: return
+        tst.ended = True
+        tst.xinput.stop()
+        tst.render(force=True)
+        txt, bg = tst.verdict()
+        tst.gui.status(txt, bg=bg)
+        if self.db: self.db.save(tst)
+        # post-mortem event history of failed session
+        if tst.history and bg == 'red': self.dumps.append((tst.devname, id, tst.history_dump()[0]))
+
+    def history(self):
+        """ dump event history of all running sessions into their tile footers (SIGUSR1) """
+        for tst in self.sessions.values():
+            if tst.history and tst.xinput.is_running(): tst.gui.status(*tst.history_dump())
+
+    def hotplug(self):
+        """ start sessions for newly connected devices and free tiles of disconnected ones """
+        now = time.time()
+        # rescan only for a while after hot-plug notification
+        if now > self.settling or now - self.lastscan < self.SCAN: return
+        self.lastscan = now
+        act = self.scan()
+        probed = set([ id for id,backend in self.probes.values() ])
+        for id in act - self.ref - probed:
+            if id in self.sessions and self.sessions[id].xinput.is_running(): continue
+            self.probe(id)
+        for id in self.ref - act:
+            for fd,(pid,backend) in self.probes.items():
+                if pid == id:
+                    backend.stop()
+                    del self.probes[fd]
+            if id not in self.sessions: continue
+            if self.sessions[id].xinput.is_running(): self.end_session(id)
+            self.slots[self.slots.index(id)] = None
+            self.offscreen.discard(id)
+            del self.sessions[id]
+        self.ref = act
+
+    def show_header(self):
+        gui = Gui('')
+        gui.write_at(1, 1)
+        gui.clear_line()
+        sessions = '%d (%d off screen)' % (len(self.sessions), len(self.offscreen)) if self.offscreen else len(self.sessions)
+        gui.write_flush(self.header % { 'about': __about__, 'version': __version__, 'sessions': sessions })
+
+    def terminal_setup(self):
+        """ no echo, no cursor, clear screen """
+        self.stdinfd = sys.stdin.fileno()
+        self.saveattr = termios.tcgetattr(self.stdinfd)
+        noecho = self.saveattr[:]
+        noecho[3] = noecho[3] & ~termios.ECHO
+        termios.tcsetattr(self.stdinfd, termios.TCSADRAIN, noecho)
+        gui = Gui('')
+        gui.clear_screen()
+        gui.cursor_off()
+
+    def terminal_reset(self):
+        """ terminal back to normal, cursor bellow the last tile """
+        termios.tcsetattr(self.stdinfd, termios.TCSADRAIN, self.saveattr)
+        gui = Gui('')
+        gui.write_at(2 + len(self.slots) * self.tile, 1)
+        gui.cursor_on()
+        gui.flush()
+        termios.tcflush(self.stdinfd, termios.TCIFLUSH)
+
+    def run(self):
+        """ single select loop over all running sessions, signals and periodic hot-plug check """
+        signals = Signals([signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1])
+        sig = signals.fileno()
+        self.terminal_setup()
+        self.show_header()
+        try:
+            while True:
+                fds = dict([ (tst.xinput.fileno(), id) for id,tst in self.sessions.items() if tst.xinput.is_running() ])
+                fds.update([ (fd, None) for fd in self.probes ])
+                hp = self.monitor.fileno()
+                # wake up for hot-plug polling/rescan or the nearest pending frame
+                waits = [ tst.gui.frame_wait() for tst in self.sessions.values() ] + [ self.monitor.timeout() ]
+                if time.time() < self.settling: waits.append(self.SCAN)
+                waits = [ w for w in waits if w is not None ]
+                try:
+                    ready = select.select([ sig ] + fds.keys() + ([] if hp is None else [hp]), [], [],
+                                          min(waits) if waits else None)[0]
+                except select.error as e:
+                    if e.args[0] != errno.EINTR: raise
+                    ready = [ sig ]
+                received = signals.received() if sig in ready else set()
+                if received & set([signal.SIGTERM, signal.SIGHUP]): break
+                if signal.SIGUSR1 in received: self.history()
+                if (hp is None or hp in ready) and self.monitor.changed():
+                    self.settling = time.time() + self.SETTLE
+                for fd in ready:
+                    if fd in (hp, sig): continue
+                    if fd in self.probes:
+                        self.probe_events(fd)
+                        continue
+                    id = fds[fd]
+                    tst = self.sessions[id]
+                    for action,keycode,tstamp in tst.xinput.events():
+                        if tst.process(action, keycode, tstamp) or tst.all_tested():
+                            self.end_session(id)
+                            break
+                    # device gone (xinput ended or event device EOF)
+                    if not tst.xinput.is_running(): self.end_session(id)
+                for tst in self.sessions.values():
+                    if tst.xinput.is_running(): tst.render()
+                self.hotplug()
+        except KeyboardInterrupt:
+            pass
+        self.monitor.close()
+        for id,backend in self.probes.values():
+            backend.stop()
+        for id,tst in self.sessions.items():
+            if tst.xinput.is_running(): self.end_session(id)
+        self.terminal_reset()
+        signals.close()
+        # results not visible in tiles
+        for id in sorted(self.offscreen):
+            tst = self.sessions[id]
+            print "%s [%s]: %s" % (tst.devname, id, tst.verdict()[0].strip(' ='))
+        for devname,id,txt in self.dumps:
+            print "%s [%s]: %s" % (devname, id, txt.strip(' ='))
+        if self.profile:
+            for line in self.profile.breakdown():
+                print line
+            if self.opts['profile'] is not True: self.profile.save(self.opts['profile'])
+
+
+class ClientOut:
+    """ output file of daemon client - non-blocking socket, data the client does not take yet are kept in bounded buffer
+        and sent when the socket is writable, too slow client gets IOError """
+
+    # max buffered output [bytes]
+    LIMIT = 256 * 1024
+
+    def __init__(self, conn):
+        conn.setblocking(0)
+        self.conn = conn
+        self.buf = ''
+
+    def write(self, data):
+        if len(self.buf) + len(data) > self.LIMIT: raise IOError(errno.ENOBUFS, "client does not read output")
+        self.buf += data
+
+    def flush(self):
+        """ send as much as socket accepts """
+        if not self.buf: return
+        try:
+            sent = self.conn.send(self.buf)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR): return
+            raise
+        self.buf = self.buf[sent:]
+
+    def fileno(self):
+        return self.conn.fileno()
+
+
+class Daemon:
+    """ long running station serving front-end terminals over Unix socket - keymap, parsed layouts, device registry and
+        hot-plug monitor stay warm, each attached terminal runs one test session drawn on (or streamed to) that terminal """
+
+    # rescan period [s] and duration after hot-plug notification (X server registers device a bit later)
+    SCAN, SETTLE = 0.1, 2.0
+
+    # max time [s] to send the rest of output to disconnected client
+    DRAIN = 5.0
+
+    def __init__(self, backend=Xinput, opts=None, dashboard=None):
+        """ backend is input class Xinput or Evdev, opts are command line options (default for all sessions),
+            dashboard is started Dashboard """
+        self.backend = backend
+        self.opts = opts or {}
+        self.dashboard = dashboard
+        self.path = self.socket_path(self.opts.get('daemon'))
+        # device list and version shared by all sessions
+        self.registry = Registry(backend())
+        self.registry.prefetch()
+        # results database --db=path
+        self.db = ResultsDB(self.opts['db']) if self.opts.get('db') else None
+        # client fd -> socket, received incomplete command, output, Test session
+        self.clients, self.bufs, self.outs, self.sessions = {}, {}, {}, {}
+        # client fd -> time to give up sending the rest of output
+        self.closing = {}
+
+    @staticmethod
+    def socket_path(path=None):
+        """ control socket path, default per user in runtime dir """
+        if path and path is not True: return path
+        return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', 'kbd-tst-%d.sock' % os.getuid())
+
+    def setup(self, gmapfname):
+        """ warm up - default layout, device list, hot-plug monitor and control socket, returns error or None """
+        self.gmapfname = Test(self.backend(), registry=self.registry).gmap_filename(gmapfname)
+        if not self.gmapfname: return "no layout file"
+        gmap, errs = self.layout(self.gmapfname)
+        for err in errs:
+            print "ERR: %s: %s" % (self.gmapfname, err)
+        self.registry.list()
+        self.monitor = HotPlug()
+        self.settling, self.lastscan = 0, 0
+        return self.listen()
+
+    def layout(self, gmapfname):
+        """ (map, errors) of layout file (compiled layouts are kept in memory) """
+        return Layout().compile(gmapfname)
+
+    def listen(self):
+        """ bind control socket accessible only by the same user, returns error or None """
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+            probe.close()
+            return "daemon is already running on %s" % self.path
+        except socket.error:
+            pass
+        # stale socket of ended daemon
+        if os.path.exists(self.path): os.unlink(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self.server.bind(self.path)
+        except socket.error as e:
+            return "%s - %s" % (self.path, e.strerror)
+        finally:
+            os.umask(umask)
+        self.server.listen(8)
+
+    def log(self, txt):
+        print "%s %s" % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), txt)
+        sys.stdout.flush()
+
+    def accept(self):
+        """ new front-end terminal """
+        conn,_ = self.server.accept()
+        self.clients[conn.fileno()] = conn
+        self.bufs[conn.fileno()] = ''
+        self.outs[conn.fileno()] = ClientOut(conn)
+
+    def receive(self, fd):
+        """ read commands (JSON line each) from client, EOF = client detached """
+        try:
+            data = self.clients[fd].recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR): return
+            data = ''
+        if not data: return self.detach(fd)
+        # disconnected client waiting for the rest of output
+        if fd in self.closing: return
+        self.bufs[fd] += data
+        while fd in self.clients and '\n' in self.bufs[fd]:
+            line, self.bufs[fd] = self.bufs[fd].split('\n', 1)
+            self.command(fd, line)
+
+    def reply(self, fd, record):
+        """ JSON line to client """
+        try:
+            self.outs[fd].write(json.dumps(record, sort_keys=True) + '\n')
+            self.outs[fd].flush()
+        except (IOError, OSError):
+            pass
+
+    def command(self, fd, line):
+        """ start / resize / status """
+        try:
+            cmd = json.loads(line)
+        except ValueError:
+            cmd = {}
+        name = cmd.get('cmd')
+        if name == 'start':
+            self.start(fd, cmd)
+        elif name == 'resize' and fd in self.sessions and not self.sessions[fd].headless:
+            self.sessions[fd].gui.size = cmd.get('rows'), cmd.get('cols')
+            try:
+                self.sessions[fd].gui.redraw()
+            except (IOError, OSError):
+                self.detach(fd)
+        elif name == 'status':
+            self.reply(fd, self.status())
+            self.close(fd)
+        else:
+            self.reply(fd, {'error': 'unknown command: %s' % line.strip()})
+            self.close(fd)
+
+    def start(self, fd, cmd):
+        """ start session on device id with layout (default daemon layout) drawn on client terminal or streamed as
+            JSON lines (headless) """
+        launched = monotonic()
+        id, gmapfname = cmd.get('id'), cmd.get('layout') or self.gmapfname
+        # evdev device path
+        if isinstance(id, unicode): id = str(id)
+        err = None
+        if fd in self.sessions: err = "session is already running"
+        elif id is None: err = "device id required"
+        elif id in [ tst.id for tst in self.sessions.values() ]: err = "device %s is already being tested" % id
+        elif not os.path.isfile(gmapfname): err = "layout file %s not found" % gmapfname
+        if err:
+            self.reply(fd, {'error': err})
+            return self.close(fd)
+        opts = dict(self.opts)
+        del opts['daemon']
+        # headless JSON lines into client socket
+        if cmd.get('headless'): opts['headless'] = fd
+        tst = Test(self.backend(), opts=opts, registry=self.registry)
+        tst.gui.out = self.outs[fd]
+        if not tst.headless: tst.gui.size = cmd.get('rows'), cmd.get('cols')
+        tst.launched = launched
+        gmap, errs = self.layout(gmapfname)
+        tst.session_setup(gmapfname, gmap, id)
+        if self.dashboard: tst.dashboard_setup(self.dashboard)
+        self.sessions[fd] = tst
+        try:
+            err = tst.session_start(id)
+        except (IOError, OSError):
+            return self.detach(fd)
+        self.log("start id=%s [ %s ] layout=%s%s" % (id, tst.devname, gmapfname,
+                 " ERR: %s" % err if err else " first frame in %.2f ms" % (1000 * (tst.startup or 0))))
+        if err: self.end(fd)
+
+    def input(self, fd):
+        """ key events of session of client fd """
+        tst = self.sessions[fd]
+        try:
+            for action,keycode,tstamp in tst.xinput.events():
+                if tst.process(action, keycode, tstamp) or tst.all_tested(): return self.end(fd)
+        except (IOError, OSError):
+            return self.detach(fd)
+        # device gone (xinput ended or event device EOF)
+        if not tst.xinput.is_running(): self.end(fd)
+
+    def end(self, fd):
+        """ session done - report to client and disconnect it """
+        tst = self.sessions.pop(fd)
+        tst.xinput.stop()
+        try:
+            tst.render(force=True)
+            tst.report()
+        except (IOError, OSError):
+            pass
+        self.log("end id=%s [ %s ] %s" % (tst.id, tst.devname, tst.verdict()[0].strip(' =')))
+        if self.db: self.db.save(tst)
+        self.close(fd)
+
+    def detach(self, fd):
+        """ client gone - session is ended without report """
+        tst = self.sessions.pop(fd, None)
+        if tst:
+            tst.xinput.stop()
+            self.log("detached id=%s [ %s ] %s" % (tst.id, tst.devname, tst.verdict()[0].strip(' =')))
+            if self.dashboard: self.dashboard.message(str(tst.id), " = Detached = %s" % tst.verdict()[0], 'yellow')
+            if self.db: self.db.save(tst)
+        self.close(fd, drain=False)
+
+    def close(self, fd, drain=True):
+        """ disconnect client when the rest of its output is sent (or DRAIN timeout) """
+        if drain and self.outs[fd].buf:
+            self.closing.setdefault(fd, time.time() + self.DRAIN)
+            return
+        conn = self.clients.pop(fd)
+        del self.bufs[fd], self.outs[fd]
+        self.closing.pop(fd, None)
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        conn.close()
+
+    def status(self):
+        """ daemon state for status command """
+        return {
+            'socket': self.path,
+            'layout': self.gmapfname,
+            'devices': dict([ (str(id), name) for id,name in self.registry.names().items() ]),
+            'sessions': [ { 'id': tst.id, 'device': tst.devname, 'layout': tst.gmapfname,
+                            'tested': tst.layout.ntested, 'total': len(tst.layout.layout) + tst.key_missing }
+                          for tst in self.sessions.values() ]
+        }
+
+    def history(self):
+        """ dump event history of all sessions (SIGUSR1) """
+        for tst in self.sessions.values():
+            if tst.history: self.log("id=%s [ %s ] %s" % (tst.id, tst.devname, tst.history_dump()[0].strip(' =')))
+
+    def send(self, fd):
+        """ client socket writable - send buffered output, disconnect drained closing client """
+        try:
+            self.outs[fd].flush()
+        except (IOError, OSError):
+            return self.detach(fd)
+        if fd in self.closing and not self.outs[fd].buf: self.close(fd)
+
+    def hotplug(self):
+        """ refresh device list for a while after hot-plug notification, end sessions of removed xinput devices """
+        now = time.time()
+        if now > self.settling or now - self.lastscan < self.SCAN: return
+        self.lastscan = now
+        self.registry.refresh()
+        connected = self.registry.names()
+        for fd,tst in self.sessions.items():
+            # xinput test keeps running silently when its device is removed
+            if tst.xinput.exe == 'xinput' and tst.id not in connected: self.end(fd)
+
+    def run(self):
+        """ single select loop over control socket, clients, session inputs, hot-plug monitor and signals """
+        signals = Signals([signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1])
+        server, sig = self.server.fileno(), signals.fileno()
+        self.log("listening on %s layout=%s" % (self.path, self.gmapfname))
+        try:
+            while True:
+                inputs = dict([ (tst.xinput.fileno(), fd) for fd,tst in self.sessions.items() if tst.xinput.is_running() ])
+                hp = self.monitor.fileno()
+                # wake up for hot-plug polling/rescan or the nearest pending frame
+                waits = [ tst.gui.frame_wait() for tst in self.sessions.values() ] + [ self.monitor.timeout() ]
+                if time.time() < self.settling: waits.append(self.SCAN)
+                if self.closing: waits.append(max(0, min(self.closing.values()) - time.time()))
+                waits = [ w for w in waits if w is not None ]
+                fds = [ sig, server ] + self.clients.keys() + inputs.keys() + ([] if hp is None else [hp])
+                pending = [ fd for fd,out in self.outs.items() if out.buf ]
+                try:
+                    ready, writable, _ = select.select(fds, pending, [], min(waits) if waits else None)
+                except select.error as e:
+                    if e.args[0] != errno.EINTR: raise
+                    ready, writable = [ sig ], []
+                received = signals.received() if sig in ready else set()
+                if received & set([signal.SIGTERM, signal.SIGHUP]): break
+                if signal.SIGUSR1 in received: self.history()
+                if server in ready: self.accept()
+                for fd in writable:
+                    if fd in self.clients: self.send(fd)
+                for fd in ready:
+                    if fd in self.clients: self.receive(fd)
+                    if fd in inputs and inputs[fd] in self.sessions: self.input(inputs[fd])
+                for fd,deadline in self.closing.items():
+                    if time.time() > deadline: self.close(fd, drain=False)
+                if (hp is None or hp in ready) and self.monitor.changed():
+                    self.settling = time.time() + self.SETTLE
+                self.hotplug()
+                for fd,tst in self.sessions.items():
+                    try:
+                        tst.render()
+                    except (IOError, OSError):
+                        self.detach(fd)
+        except KeyboardInterrupt:
+            pass
+        for fd in self.sessions.keys():
+            self.end(fd)
+        for fd in self.clients.keys():
+            self.outs[fd].conn.settimeout(1.0)
+            try:
+                while self.outs[fd].buf: self.outs[fd].flush()
+            except (IOError, OSError):
+                pass
+            self.close(fd, drain=False)
+        self.server.close()
+        os.unlink(self.path)
+        self.monitor.close()
+        signals.close()
+
+
+class Attach:
+    """ front-end terminal of daemon - starts the session in daemon and shows it, CTRL-C detaches """
+
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+        self.path = Daemon.socket_path(self.opts.get('attach'))
+        self.headless = self.opts.get('headless')
+
+    def connect(self):
+        """ connected control socket or None """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error as e:
+            print >>sys.stderr, "no daemon on %s - %s" % (self.path, e.strerror)
+            return None
+        return sock
+
+    def send(self, sock, record):
+        sock.sendall(json.dumps(record) + '\n')
+
+    def run(self, id=None, layout=None):
+        """ start session for device id (daemon status without id), returns exit code """
+        sock = self.connect()
+        if not sock: return 2
+        # layout path as seen by the daemon
+        if layout and os.path.isfile(layout): layout = os.path.abspath(layout)
+        if id is None:
+            self.send(sock, {'cmd': 'status'})
+        elif self.headless:
+            self.send(sock, {'cmd': 'start', 'id': id, 'layout': layout, 'headless': True})
         else:
-            self.gui.banner(" = TEST FAILED = Only %d of %d [ %.1f%% ] keys has been successfully tested @ %s = " \
-                        % (tested, total, 100.0*tested/total, now), bg='red', above=2, bellow=1)
+            rows, cols = Gui('').term_size()
+            self.send(sock, {'cmd': 'start', 'id': id, 'layout': layout, 'rows': rows, 'cols': cols})
+        out = 1 if self.headless in (None, True) else int(self.headless)
+        interactive = not self.headless and id is not None
+        signals = Signals([signal.SIGTERM, signal.SIGHUP] + ([signal.SIGWINCH] if interactive else []))
+        if interactive: self.terminal_setup()
+        last = ''
+        try:
+            while True:
+                try:
+                    ready = select.select([ sock.fileno(), signals.fileno() ], [], [])[0]
+                except select.error as e:
+                    if e.args[0] != errno.EINTR: raise
+                    ready = [ signals.fileno() ]
+                if signals.fileno() in ready:
+                    received = signals.received()
+                    if received & set([signal.SIGTERM, signal.SIGHUP]): break
+                    if signal.SIGWINCH in received:
+                        rows, cols = Gui('').term_size()
+                        self.send(sock, {'cmd': 'resize', 'rows': rows, 'cols': cols})
+                if sock.fileno() not in ready: continue
+                data = sock.recv(65536)
+                if not data: break
+                last = (last + data)[-65536:]
+                while data:
+                    data = data[os.write(out, data):]
+        except KeyboardInterrupt:
+            pass
+        sock.close()
+        signals.close()
+        if interactive: self.terminal_reset()
+        return self.exit_code(last)
+
+    def exit_code(self, last):
+        """ 2 for daemon error, 1 for failed headless test (summary record), 0 otherwise """
+        try:
+            record = json.loads(last.rstrip('\n').rsplit('\n', 1)[-1])
+        except ValueError:
+            return 1 if self.headless else 0
+        if 'error' in record: return 2
+        return 1 if record.get('result') == 'failed' else 0
+
+    def terminal_setup(self):
+        """ no echo, no cursor (the session is drawn by daemon) """
+        self.stdinfd = sys.stdin.fileno()
+        self.saveattr = termios.tcgetattr(self.stdinfd)
+        noecho = self.saveattr[:]
+        noecho[3] = noecho[3] & ~termios.ECHO
+        termios.tcsetattr(self.stdinfd, termios.TCSADRAIN, noecho)
+        Gui('').cursor_off()
+
+    def terminal_reset(self):
+        """ terminal back to normal """
+        termios.tcsetattr(self.stdinfd, termios.TCSADRAIN, self.saveattr)
+        gui = Gui('')
+        gui.cursor_on()
+        gui.color_reset()
+        gui.flush()
+        termios.tcflush(self.stdinfd, termios.TCIFLUSH)
+
+
+class Bench:
+    """ benchmark of event -> render pipeline with synthetic bursts, output is JSON line per layout and profile """
+
+    # shipped layouts (relative to kbd-tst dir)
+    LAYOUTS = [ 'at101.lay', 'layouts/apple.lay', 'layouts/ku-450-en.lay' ]
+
+    # events per layout and profile
+    EVENTS = 20000
+
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+        # drawing output of all measured sessions
+        self.devnull = None
+
+    def run(self, layouts=None):
+        """ measure all profiles for all layouts """
+        home = os.path.dirname(os.path.abspath(__file__))
+        self.devnull = open(os.devnull, 'w')
+        try:
+            for fname in layouts or [ os.path.join(home, f) for f in self.LAYOUTS ]:
+                for profile in Synthetic.PROFILES:
+                    print json.dumps(self.measure(fname, profile), sort_keys=True)
+                    sys.stdout.flush()
+        finally:
+            self.devnull.close()
+
+    def measure(self, fname, profile):
+        """ feed synthetic events through keypress -> keycode_to_key -> key_action -> update_stats -> render """
+        layout = Layout()
+        gmap, errs = layout.compile(fname)
+        keycodes = [ v['keycode'] for v in sorted(layout.layout.values(), key=lambda v: (v['row'], v['col'])) ]
+        tst = Test(Synthetic(keycodes, profile, self.EVENTS), opts=self.opts)
+        tst.gui.out = self.devnull
+        # measure pipeline, not frame pacing
+        tst.gui.FRAME_MIN = tst.gui.FRAME_MAX = tst.gui.VISIBLE = 0
+        tst.session_setup(fname, gmap, 'bench')
+        tst.xinput.start()
+        tst.gui.show_map()
+        tst.gui.set_keys(tst.layout.layout.values())
+        # per event latency from event timestamp to flushed render
+        lat = array.array('d')
+        start = monotonic()
+        while tst.xinput.is_running():
+            events = tst.keypress()
+            for action,keycode,tstamp in events:
+                tst.process(action, keycode, tstamp)
+            tst.gui.render()
+            done = monotonic()
+            lat.extend([ done - tstamp for action,keycode,tstamp in events ])
+        elapsed = monotonic() - start
+        lat = sorted(lat)
+        pct = lambda q: round(1e6 * percentile(lat, q), 2) if lat else None
+        return {
+            'layout': os.path.basename(fname),
+            'profile': profile,
+            'keys': len(keycodes),
+            'events': len(lat),
+            'events_per_s': round(len(lat) / elapsed, 1) if elapsed else None,
+            'p50_us': pct(0.5),
+            'p99_us': pct(0.99),
+            'p999_us': pct(0.999)
+        }
 
 
 def parse_argv(argv):
     """ process parameters in arbitrary order """
-    id, layout = None, None
+    # switches -> option name
+    switches = {
+        '-e': 'evdev',   '--evdev': 'evdev',
+        '-s': 'station', '--station': 'station',
+        '-f': 'frames',  '--frames': 'frames',
+        '--fast': 'fast',
+        '--bench': 'bench',
+        '-r': 'rollover', '--rollover': 'rollover',
+        '--headless': 'headless',
+        '--query': 'query',
+        '--profile': 'profile',
+        '--latency': 'latency',
+        '-a': 'autolayout', '--autolayout': 'autolayout',
+        '--daemon': 'daemon',
+        '--attach': 'attach',
+        '--dashboard': 'dashboard',
+        '--history': 'history'
+    }
+    # options with value --name=value
+    values = [ 'record', 'replay', 'chatter', 'rate', 'headless', 'db', 'query', 'idle', 'profile', 'daemon', 'attach',
+               'dashboard', 'history' ]
+    id, layout, opts = None, None, {}
     for par in argv:
         if par in ['-h', '--help']:
             print "=",__about__,"version",__version__,"=",__copyright__,"="
             print __usage__
             sys.exit()
+        if par in switches:
+            opts[switches[par]] = True
+            continue
+        name,_,value = par[2:].partition('=')
+        if par.startswith('--') and name in values:
+            opts[name] = value
+            continue
         if par.isdigit():
             id = int(par)
+        elif Evdev.is_device(par):
+            id = par
+            opts['evdev'] = True
         else:
             layout = par
-    return id, layout
+    return id, layout, opts
 
 
 if __name__ == '__main__':
 
-    tst = Test()
+    id, layout, opts = parse_argv(sys.argv[1:])
+    #
+    if opts.get('bench'):
+        Bench(opts).run(layout and [layout])
+        sys.exit()
+    #
+    if opts.get('query'):
+        if not opts.get('db'):
+            print >>sys.stderr, "query requires results database --db=path"
+            sys.exit(2)
+        ResultsDB(opts['db']).query(None if opts['query'] is True else opts['query'])
+        sys.exit()
+    #
+    # front-end of running daemon
+    if opts.get('attach'):
+        sys.exit(Attach(opts).run(id, layout))
+    #
+    # live dashboard of all sessions for supervisors
+    dashboard = Dashboard(opts['dashboard']) if opts.get('dashboard') else None
+    if dashboard:
+        err = dashboard.start()
+        if err:
+            print >>sys.stderr, err
+            sys.exit(2)
+        print "Dashboard: %s" % dashboard.url()
+        sys.stdout.flush()
+    #
+    if opts.get('daemon'):
+        daemon = Daemon(Evdev if opts.get('evdev') else Xinput, opts, dashboard)
+        Layout.keymap = Keymap(evdev=opts.get('evdev'))
+        err = daemon.setup(layout)
+        if err:
+            print >>sys.stderr, err
+            sys.exit(2)
+        daemon.run()
+        if dashboard: dashboard.stop()
+        sys.exit()
+    #
+    if opts.get('station'):
+        station = Station(Evdev if opts.get('evdev') else Xinput, opts, dashboard)
+        # live keymap for layout labels (while the device list is enumerated)
+        Layout.keymap = Keymap(evdev=opts.get('evdev'))
+        station.setup(layout, [] if id is None else [id])
+        station.run()
+        if dashboard: dashboard.stop()
+        sys.exit()
+    #
+    if opts.get('replay'):
+        # replayed session log is the device
+        xinput = Replay(opts['replay'], fast=opts.get('fast'))
+        id = opts['replay'] if id is None else id
+    else:
+        xinput = Evdev() if opts.get('evdev') else Xinput()
+    # version and device list are enumerated while live keymap is discovered
+    registry = Registry(xinput)
+    registry.prefetch()
+    Layout.keymap = Keymap(evdev=opts.get('evdev'))
+    if opts.get('record'):
+        xinput = Record(xinput, opts['record'])
+    #
+    # no user assisted autodetection without terminal
+    if opts.get('headless') and id is None:
+        print >>sys.stderr, "headless mode requires keyboard id or device"
+        sys.exit(2)
     #
-    id, layout = parse_argv(sys.argv[1:])
+    tst = Test(xinput, opts=opts, registry=registry)
     tst.pars_setup(layout, id)
+    if dashboard: tst.dashboard_setup(dashboard)
     #
     tst.test_setup()
     tst.test_run()
     tst.test_teardown()
     #
-    tst.report()
+    passed = tst.report()
+    if dashboard: dashboard.stop()
+    if opts.get('db'): ResultsDB(opts['db']).save(tst)
+    if opts.get('profile') not in (None, True): tst.profile.save(opts['profile'])
+    # exit code for scripted runs
+    if opts.get('headless'): sys.exit(0 if passed else 1)
 
@@ -6,7 +6,8 @@
 # just after the line rev_xmodmap between { } to replace existing content there
 #
 # Using this utility is only necessary for future extension of handling special or non-standard
-# keyboard layouts with special keys
+# keyboard layouts with special keys. kbd-tst.py discovers the live keymap at startup (Keymap class)
+# with the same translations, the dictionary is used only as fallback for labels not found there
 #
 # GITHUB: https://github.com/blue-sky-r/keyboard-test
 #